@@ -1,11 +1,25 @@
+import os
+import time
+import json
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import yfinance as yf
+import numpy as np
 import pandas as pd
-import json
+from datacache import read_csv_cached, load_sidecar, save_sidecar, file_signature
 
 # -------------------------------------------------
 # parameters
 # -------------------------------------------------
 exe_tble_path = r"C:\Users\yktkk\Desktop\DS_practice\programing\WebPage\datadash\dataset\execute_table\execute_tble.xlsx"
+# 株価履歴キャッシュの有効期間(秒)。これを過ぎると不足している末尾だけ取得し直す
+history_ttl = 60 * 60
+# 保持しておくTickerオブジェクトの最大数
+ticker_pool_size = 64
 
 
 # -------------------------------------------------
@@ -30,59 +44,173 @@ def load_json(file_path):
     except Exception as e:
         print(f"エラー: {e}")
 
+# latest flag, execute list
+def latest_flags(kinds:pd.Series,
+                 dates:pd.Series)->np.ndarray:
+    """
+    異常検知種ごとに、更新日が最小の行に "●"、それ以外の行に None を付けた配列を返す
+
+    groupby/transform で種別ごとの最小日付を1回で求めるので、行数×種別数のループにならない。
+    (種別の全ての更新日が欠損の場合は、欠損の行に "●" を付ける。種別が欠損の行は None)
+
+    :param kinds: 異常検知種の列
+    :param dates: 更新日の列 (datetime型)
+    """
+    mindate = dates.groupby(kinds, sort=False, observed=True).transform("min")
+    flag = (dates == mindate) | (dates.isna() & mindate.isna() & kinds.notna())
+    return np.where(flag, "●", None)
+
 # loader, execute list
 class DataExe:
+    """
+    実行テーブル(execute_tble.xlsx)の先頭 top_n 行を読み込む
+
+    Excelの読み込みは遅いので、変換済み(更新日順・latestフラグ付き)の表を
+    Featherのキャッシュ(<ブック>.feather)に保存し、ブックの更新日時・サイズと読み込む列が
+    同じ間はキャッシュの先頭 top_n 行だけを読み込む。
+    """
 
     def __init__(self,
-                 exe_tble_path:str=exe_tble_path)->None:
+                 exe_tble_path:str=exe_tble_path,
+                 columns:list=None,
+                 top_n:int=20)->None:
+        """
+        :param exe_tble_path: 実行テーブルのパス
+        :param columns: 読み込む列 (Noneの場合は全ての列。異常検知種・更新日は必ず読み込む)
+        :param top_n: 表示する行数 (更新日の古い順)
+        """
 
         # file
         self.exe_tble_path = exe_tble_path
+        self.columns = columns
+        self.top_n = top_n
         # load
         self.__loadfiles()
 
+    def __usecols(self,)->list:
+        if self.columns is None:
+            return None
+        return list(dict.fromkeys(["異常検知種", "更新日", *self.columns]))
+
     def __loadfiles(self,):
+        usecols = self.__usecols()
+        cache_key = json.dumps(usecols, ensure_ascii=False)
+        # cache
+        cached = load_sidecar(self.exe_tble_path, head=self.top_n)
+        if cached is not None and cached[1].get("usecols") == cache_key:
+            self.exe_tble = cached[0]
+            return
+
         # exe table
-        self.exe_tble = pd.read_excel(self.exe_tble_path)
+        signature = file_signature(self.exe_tble_path)
+        exe_tble = pd.read_excel(self.exe_tble_path, usecols=usecols)
         # preprocessing
-        self.exe_tble["更新日"] = pd.to_datetime(self.exe_tble["更新日"])
-        self.exe_tble.sort_values(by="更新日", inplace=True)
-        # latest flg
-        flg = {}
-        for k in self.exe_tble["異常検知種"].unique():
-            # mindate
-            mindate = self.exe_tble[self.exe_tble["異常検知種"]==k]["更新日"].min()
-            flg[k] = {str(mindate):"●"}
-        latest = []
-        for k, d in zip(self.exe_tble["異常検知種"], self.exe_tble["更新日"]):
-            try:
-                latest.append(flg[k][str(d)])
-            except:
-                latest.append(None)
-        self.exe_tble["latest"] = latest
-        self.exe_tble.reset_index(drop=True)
-
-        # slice len 20
-        if len(self.exe_tble)>20:
-            self.exe_tble = self.exe_tble.iloc[:20,:]
-        print("")
+        exe_tble["更新日"] = pd.to_datetime(exe_tble["更新日"])
+        exe_tble = exe_tble.sort_values(by="更新日", kind="mergesort").reset_index(drop=True)
+        # latest flg (表全体から求める)
+        # ("●" / None のobject型にする。pandas 3 で配列のまま代入するとstr型になり欠損値がNaNになる)
+        exe_tble["latest"] = pd.Series(latest_flags(exe_tble["異常検知種"], exe_tble["更新日"]),
+                                       index=exe_tble.index, dtype=object)
+        save_sidecar(self.exe_tble_path, exe_tble, signature, {"usecols": cache_key})
+
+        # slice len top_n
+        self.exe_tble = exe_tble.iloc[:self.top_n,:]
+
+# cache, price history
+class HistoryCache:
+    """
+    銘柄ごとの株価履歴をSQLiteに保存するキャッシュ
+
+    銘柄コードごとに、取得済みの履歴(DataFrame)と、履歴がカバーしている開始日時・取得日時を1行で持つ。
+    DataFrameはタイムゾーンや型をそのまま保つためpickleで保存する(このアプリが書いたものだけを読む)。
+    """
+
+    def __init__(self,
+                 path:str)->None:
+        self.path = path
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                " code TEXT PRIMARY KEY, start REAL, fetched_at REAL, frame BLOB)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # スレッドごとに接続を作り、使い終わったら閉じる
+        # (sqlite3の接続の with はcommit/rollbackするだけで接続を閉じない)
+        with closing(sqlite3.connect(self.path, timeout=30)) as con:
+            with con:
+                yield con
+
+    def get(self,
+            code:str):
+        """
+        キャッシュを返す。無い場合はNone
+
+        :return: (履歴のDataFrame, カバーしている開始日時(epoch秒), 取得日時(epoch秒))
+        """
+        with self._connect() as con:
+            row = con.execute("SELECT frame, start, fetched_at FROM history WHERE code = ?",
+                              (code,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0]), row[1], row[2]
+        except Exception as e:
+            print(f"エラー: {code} の履歴キャッシュを読み込めません: {e}")
+            return None
+
+    def put(self,
+            code:str,
+            frame:pd.DataFrame,
+            start:float,
+            fetched_at:float)->None:
+        with self._connect() as con:
+            con.execute("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)",
+                        (code, start, fetched_at, pickle.dumps(frame)))
 
 # loader, Nikkei
 class Data:
     def __init__(self,
                  nikkei_list_file_path:str,
-                 translation_dict_path:str)->None:
+                 translation_dict_path:str,
+                 history_cache_path:str=None,
+                 history_ttl:float=history_ttl,
+                 ticker_factory=yf.Ticker,
+                 ticker_pool_size:int=ticker_pool_size)->None:
+        """
+        :param history_cache_path: 株価履歴キャッシュ(SQLite)のパス。省略時は日経リストと同じフォルダ
+        :param history_ttl: 株価履歴キャッシュの有効期間(秒)
+        :param ticker_factory: 銘柄コード("7203.T"など)からTickerを作る関数。テスト時は差し替える
+        :param ticker_pool_size: 保持しておくTickerオブジェクトの最大数
+        """
         # files
         self.nikkei_path = nikkei_list_file_path # csv file
         self.trans_path = translation_dict_path # json file
         self.__loadfiles()
 
+        # price history cache
+        if history_cache_path is None:
+            history_cache_path = os.path.join(os.path.dirname(self.nikkei_path), "history_cache.sqlite")
+        self.history_cache = HistoryCache(history_cache_path)
+        self.history_ttl = history_ttl
+        self.ticker_factory = ticker_factory
+
+        # Tickerオブジェクトのプール (コード → Ticker、古いものから破棄)
+        self.ticker_pool_size = ticker_pool_size
+        self._tickers = OrderedDict()
+        self._pool_lock = threading.Lock()
+        # 同じ銘柄の履歴を同時に取得しないための銘柄ごとのロック
+        self._code_locks = {}
+
         # company class
         self.com = None
+        self.code = None
 
     def __loadfiles(self):
         # nikkei list
-        self.nikkei = pd.read_csv(self.nikkei_path, encoding="CP932").sort_values(by="銘柄名")
+        self.nikkei = read_csv_cached(self.nikkei_path, categories=["銘柄名"],
+                                      encoding="CP932").sort_values(by="銘柄名")
         self.nikkei_items = self.nikkei.set_index("銘柄名").to_dict("index")
         # transition dict
         self.trans = load_json(self.trans_path)
@@ -96,15 +224,134 @@ class Data:
         if initialize:
             del self.com
         else:
-            self.com = yf.Ticker(code)
+            self.com = self.ticker_factory(code)
+            self.code = code
 
     def getinfo(self):
         return self.com.info
 
+    def _ticker(self,
+                symbol:str):
+        """プールからTickerを返す (無ければ作成し、上限を超えたら最も使われていないものを破棄)"""
+        with self._pool_lock:
+            ticker = self._tickers.pop(symbol, None)
+            if ticker is None:
+                ticker = self.ticker_factory(symbol)
+            self._tickers[symbol] = ticker
+            while len(self._tickers) > self.ticker_pool_size:
+                self._tickers.popitem(last=False)
+            return ticker
+
+    def _code_lock(self,
+                   symbol:str):
+        with self._pool_lock:
+            return self._code_locks.setdefault(symbol, threading.Lock())
+
+    def history(self,
+                code:str,
+                period:int):
+        """
+        銘柄コードを指定して直近 period 日の株価履歴を新しい順で返す
+
+        インスタンスの状態(set_companyで設定した銘柄)を使わないので、
+        複数のスレッドから同時に呼び出してよい。キャッシュの扱いは gethistory と同じ。
+
+        :param code: 銘柄コード ("7203"など、".T"は付けない)
+        :param period: 日数
+        """
+        symbol = str(code) + ".T"
+        with self._code_lock(symbol):
+            return self._cached_history(symbol, self._ticker(symbol), period)
+
+    def prefetch_history(self,
+                         period:int,
+                         max_workers:int=8,
+                         downloader=None,
+                         progress=None):
+        """
+        日経リストの全銘柄の株価履歴をまとめて取得し、キャッシュに保存する (起動時のウォームアップ用)
+
+        キャッシュが period 日分をカバーしていて有効期間内の銘柄は取得しない。
+        取得は max_workers 本のスレッドで並行して行う。
+
+        :param period: 取得する日数 (画面で選べる最大の日数を指定すると、全ての表示がキャッシュから返る)
+        :param max_workers: 同時に取得するスレッド数
+        :param downloader: (銘柄コード"7203.T", 日数) → DataFrame の関数。省略時はyfinanceで取得
+        :param progress: (完了数, 全体数, 銘柄コード, 結果) を受け取る関数。省略時はprintする
+                         結果は "fetched" / "cached" / "empty" / 例外オブジェクト のいずれか
+        :return: {銘柄コード: 結果}
+        """
+        if downloader is None:
+            downloader = lambda symbol, days: self._ticker(symbol).history(f"{days}d")
+        if progress is None:
+            progress = lambda done, total, symbol, result: print(f"prefetch {done}/{total} {symbol} {result}")
+
+        def fetch(symbol):
+            with self._code_lock(symbol):
+                now = time.time()
+                start = now - period * 24 * 60 * 60
+                cached = self.history_cache.get(symbol)
+                if cached is not None and cached[1] <= start and now - cached[2] <= self.history_ttl:
+                    return "cached"
+                hist = downloader(symbol, period)
+                if hist is None or hist.empty:
+                    return "empty"
+                self.history_cache.put(symbol, hist, start, now)
+                return "fetched"
+
+        symbols = [str(item["コード"]).zfill(4) + ".T" for item in self.nikkei_items.values()]
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {ex.submit(fetch, symbol): symbol for symbol in symbols}
+            for done, future in enumerate(as_completed(futures), start=1):
+                symbol = futures[future]
+                try:
+                    results[symbol] = future.result()
+                except Exception as e:
+                    results[symbol] = e
+                progress(done, len(symbols), symbol, results[symbol])
+        return results
+
     def gethistory(self,
                    period:int):
-        period = f"{period}d"
-        return self.com.history(period).sort_index(ascending=False)
+        """
+        直近 period 日の株価履歴を新しい順で返す
+
+        取得済みの履歴がキャッシュにあり、期間をカバーしていればキャッシュから切り出して返す。
+        キャッシュが history_ttl より古い場合は、最後の日付以降だけを取得して追加する。
+        より長い期間が要求された場合だけ、その期間の履歴をまとめて取得し直す。
+        """
+        with self._code_lock(self.code):
+            return self._cached_history(self.code, self.com, period)
+
+    def _cached_history(self,
+                        code:str,
+                        ticker,
+                        period:int):
+        now = time.time()
+        start = now - period * 24 * 60 * 60
+        cached = self.history_cache.get(code)
+
+        if cached is None or cached[1] > start:
+            # 未取得、またはキャッシュより長い期間 → 期間全体を取得
+            hist = ticker.history(f"{period}d")
+            if hist.empty:
+                return hist
+            self.history_cache.put(code, hist, start, now)
+        else:
+            hist, cached_start, fetched_at = cached
+            if now - fetched_at > self.history_ttl:
+                # 有効期間切れ → 最後の日付以降だけ取得して置き換える
+                last = hist.index.max()
+                tail = ticker.history(start=last.strftime("%Y-%m-%d"))
+                if not tail.empty:
+                    hist = pd.concat([hist[hist.index < tail.index.min()], tail])
+                self.history_cache.put(code, hist, cached_start, now)
+
+        # 直近 period 日分(今日を含む)を、履歴のタイムゾーンでの日付単位で切り出す
+        # (tz無しの履歴の場合はUTCとして扱う)
+        begin = pd.Timestamp(start, unit="s", tz="UTC").tz_convert(hist.index.tz)
+        return hist[hist.index > begin.floor("D")].sort_index(ascending=False)
 
 # debub
 if __name__ == "__main__":
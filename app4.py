@@ -1,16 +1,28 @@
 import os
 import io
-import shutil
-import base64
+import hashlib
+import threading
+from urllib.parse import quote
 import numpy as np
 import pandas as pd
-import matplotlib
-matplotlib.use('Agg')  # Flask上でmatplotlibを動かす場合のおまじない（GUIバックエンドを使わない）
-import matplotlib.pyplot as plt
-from flask import Flask, render_template_string, request, redirect, url_for, session, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, send_file, Response, abort
+from jinja2 import DictLoader
+from werkzeug.security import safe_join
+from compression import Compressor
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'  # セッション管理用のシークレットキー
+# HTML・JSONのレスポンスを圧縮して返す
+Compressor(app)
+
+# ダウンロード用ZIPファイルの置き場所
+DOWNLOAD_DIR = os.path.abspath("./data/datalog")
+# リバースプロキシ配下でファイル送信をプロキシに任せる場合の設定
+#   Apache (mod_xsendfile) など: USE_X_SENDFILE=1 → X-Sendfile ヘッダーで返す
+#   nginx: X_ACCEL_REDIRECT_PREFIX=/protected/datalog → X-Accel-Redirect ヘッダーで返す
+#          (nginx側は location /protected/datalog/ { internal; alias <DOWNLOAD_DIR>/; } のように設定)
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
 
 # ユーザーIDとパスワードを辞書形式で複数管理
 users = {
@@ -49,29 +61,65 @@ df_anomaly = pd.DataFrame(result_data)
 #####################################
 # 箱ひげ図生成用の関数
 #####################################
-def generate_boxplot(target_name):
+def generate_boxplot(target_name, data):
     """
-    指定された目的変数名に対応するサンプルの箱ひげ図を作成し、base64エンコードした文字列を返す
+    指定された目的変数名とサンプルデータから箱ひげ図を作成し、PNGのバイト列を返す
     """
-    data = np.random.randn(50) * 10  # 適当なサンプルデータ
+    # matplotlibは読み込みが重いので、最初に箱ひげ図を作るときに読み込む
+    import matplotlib
+    matplotlib.use('Agg')  # Flask上でmatplotlibを動かす場合のおまじない（GUIバックエンドを使わない）
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(4, 3))
     plt.boxplot(data)
     plt.title(f"{target_name} の箱ひげ図")
     buf = io.BytesIO()
     plt.savefig(buf, format="png")
     plt.close()
-    buf.seek(0)
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
-
-# 目的変数3種(A, B, C)の静的画像(base64)をあらかじめ生成しておく
-boxplot_imgs = {
-    "目的変数A": generate_boxplot("目的変数A"),
-    "目的変数B": generate_boxplot("目的変数B"),
-    "目的変数C": generate_boxplot("目的変数C")
-}
+    return buf.getvalue()
+
+# 目的変数3種(A, B, C)
+BOXPLOT_TARGETS = ("目的変数A", "目的変数B", "目的変数C")
+# 画像のブラウザキャッシュ期間(秒)。URLにデータのハッシュが入るので、データが変われば別のURLになる
+BOXPLOT_MAX_AGE = 365 * 24 * 60 * 60
+
+# 箱ひげ図のデータ {目的変数名: (サンプルデータ, データのハッシュ)}
+_boxplot_data = {}
+# 作成済みの箱ひげ図 {(目的変数名, データのハッシュ): PNGのバイト列}
+_boxplot_cache = {}
+_boxplot_lock = threading.Lock()
+
+def boxplot_data(target_name):
+    """
+    箱ひげ図のサンプルデータと、その内容のハッシュ(画像のURLとETagに使う版)を返す
+    """
+    entry = _boxplot_data.get(target_name)
+    if entry is None:
+        with _boxplot_lock:
+            entry = _boxplot_data.get(target_name)
+            if entry is None:
+                data = np.random.randn(50) * 10  # 適当なサンプルデータ
+                entry = (data, hashlib.sha1(data.tobytes()).hexdigest()[:16])
+                _boxplot_data[target_name] = entry
+    return entry
+
+def boxplot_png(target_name):
+    """
+    箱ひげ図のPNGとデータのハッシュを返す。(目的変数名, ハッシュ) ごとに初回の要求時に1回だけ作成する
+    (pyplotはスレッドセーフではないので、作成はロックの中で行う)
+    """
+    data, version = boxplot_data(target_name)
+    key = (target_name, version)
+    png = _boxplot_cache.get(key)
+    if png is None:
+        with _boxplot_lock:
+            png = _boxplot_cache.get(key)
+            if png is None:
+                png = generate_boxplot(target_name, data)
+                _boxplot_cache[key] = png
+    return png, version
 
 #####################################
-# テンプレート (render_template_stringで定義)
+# テンプレート (文字列で定義し、DictLoaderで名前を付けて読み込む)
 #####################################
 
 # ログインページ
@@ -403,9 +451,10 @@ anomaly_template = """
                 <option value="C">目的変数C</option>
             </select>
             <div>
-                <img id="plot-A" src="data:image/png;base64,{{ boxplot_imgs['目的変数A'] }}" style="display:block; max-width:400px;">
-                <img id="plot-B" src="data:image/png;base64,{{ boxplot_imgs['目的変数B'] }}" style="display:none; max-width:400px;">
-                <img id="plot-C" src="data:image/png;base64,{{ boxplot_imgs['目的変数C'] }}" style="display:none; max-width:400px;">
+                <!-- 表示中の画像だけを読み込む (B, C は選択されたときに data-src から読み込む) -->
+                <img id="plot-A" src="{{ boxplot_urls['目的変数A'] }}" style="display:block; max-width:400px;">
+                <img id="plot-B" data-src="{{ boxplot_urls['目的変数B'] }}" style="display:none; max-width:400px;">
+                <img id="plot-C" data-src="{{ boxplot_urls['目的変数C'] }}" style="display:none; max-width:400px;">
             </div>
         </div>
 
@@ -449,6 +498,10 @@ anomaly_template = """
         // ----- 箱ひげ図の切り替え -----
         function switchBoxplot() {
             let val = document.getElementById("target-dropdown").value;
+            let img = document.getElementById("plot-" + val);
+            if (!img.getAttribute("src")) {
+                img.src = img.dataset.src;
+            }
             document.getElementById("plot-A").style.display = (val === "A") ? "block" : "none";
             document.getElementById("plot-B").style.display = (val === "B") ? "block" : "none";
             document.getElementById("plot-C").style.display = (val === "C") ? "block" : "none";
@@ -541,6 +594,13 @@ anomaly_template = """
 </html>
 """
 
+# テンプレートは名前で読み込み、初回の描画時に1回だけコンパイルする (以降はJinjaのキャッシュを使う)
+app.jinja_loader = DictLoader({
+    "login.html": login_template,
+    "dashboard.html": dashboard_template,
+    "anomaly.html": anomaly_template,
+})
+
 #####################################
 # Flaskルーティング
 #####################################
@@ -558,7 +618,7 @@ def login():
             return redirect(url_for("dashboard"))
         else:
             error = "ユーザーIDまたはパスワードが違います。"
-    return render_template_string(login_template, error=error)
+    return render_template("login.html", error=error)
 
 # ダッシュボード（メイン画面）
 @app.route("/dashboard")
@@ -567,7 +627,7 @@ def dashboard():
         return redirect(url_for("login"))
     # df_main をテンプレートに渡してテーブル表示
     table_data = df_main.to_dict(orient="records")
-    return render_template_string(dashboard_template, table_data=table_data)
+    return render_template("dashboard.html", table_data=table_data)
 
 # 異常検知ページ(4種類)
 @app.route("/anomaly/<int:anomaly_id>")
@@ -593,22 +653,52 @@ def anomaly_page(anomaly_id):
     df_display["download"] = df_display["download"].apply(lambda x: f'<a href="/download/{x}">ダウンロード</a>')
 
     table_data = df_display.to_dict(orient="records")
-    return render_template_string(
-        anomaly_template,
+    return render_template(
+        "anomaly.html",
         anomaly_name=anomaly_name,
         table_data=table_data,
-        boxplot_imgs=boxplot_imgs
+        boxplot_urls={target: url_for("boxplot_image", target=target, v=boxplot_data(target)[1])
+                      for target in BOXPLOT_TARGETS}
     )
 
-# ZIPファイルダウンロード (静的ファイルsample.zipへのアクセス)
+# 箱ひげ図の画像
+# 例: /plots/boxplot/目的変数A.png?v=<データのハッシュ>
+@app.route("/plots/boxplot/<target>.png")
+def boxplot_image(target):
+    if not session.get("logged_in"):
+        return redirect(url_for("login"))
+    if target not in BOXPLOT_TARGETS:
+        abort(404)
+    png, version = boxplot_png(target)
+    if request.args.get("v") != version:
+        # 古い版のURLなど: 内容が変わりうるので毎回確認させる
+        return send_file(io.BytesIO(png), mimetype="image/png",
+                         etag=version, conditional=True, max_age=0)
+    # URLにデータのハッシュが入るので、同じURLの間は内容が変わらない
+    # (ログインが必要な画像なので共有キャッシュには置かせない)
+    response = send_file(io.BytesIO(png), mimetype="image/png",
+                         etag=version, conditional=True, max_age=BOXPLOT_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+# ZIPファイルダウンロード
 @app.route("/download/<path:filename>")
 def download_file(filename):
-    # staticフォルダ内のファイルをダウンロード可能にする
-    # copy
-    filename_ = os.path.join("./data/datalog", filename)
-    basename = os.path.basename(filename_)
-    shutil.copy(filename_, os.path.join("./src/download", basename))
-    return send_from_directory(directory="download", path=filename, as_attachment=True)
+    # コピーせずに ./data/datalog から直接配信する
+    # (conditional=True で Range / If-None-Match に対応。USE_X_SENDFILE が有効なら X-Sendfile で返す)
+    if X_ACCEL_REDIRECT_PREFIX:
+        # nginx 配下: ファイルの送信は nginx に任せ、Flask はヘッダーだけ返す
+        path = safe_join(DOWNLOAD_DIR, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = Response(mimetype="application/zip")
+        response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(filename)
+        response.headers.set("Content-Disposition", "attachment", filename=os.path.basename(path))
+        return response
+    return send_from_directory(directory=DOWNLOAD_DIR, path=filename,
+                               as_attachment=True, conditional=True)
 
 #####################################
 # メイン
@@ -0,0 +1,299 @@
+# benchmark
+# 使い方: python benchmark.py graphpath --rows 1000000
+#   startup は proto_type3.py を新しいプロセスで import して計測する (読み込めないデータはスキップ)
+#   importtime は python -X importtime で各モジュールの import 時間を計測する (起動時間の悪化の確認用)
+#   main.py を import するベンチマークは、アプリと同じく config.py と data\detection_tbl.csv が必要
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+
+
+# -------------------------------------------------
+# functions
+# -------------------------------------------------
+def measure(func, *args, repeat:int=3, **kwargs):
+    """
+    funcをrepeat回実行し、最速の実行時間(秒)と最後の戻り値を返す
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def report(name:str, seconds:float, base:float=None):
+    ratio = f"  (x{base / seconds:.1f})" if base else ""
+    print(f"  {name:<32}: {seconds * 1000:10.1f} ms{ratio}")
+
+def make_detection_table(rows:int)->pd.DataFrame:
+    """
+    make_dataset.ipynb と同じ形式の検知結果テーブルを rows 行作成する
+    (パスは相対パスと Windows の絶対パスが混在している想定)
+    """
+    i = np.arange(rows)
+    kinds = np.array(list("ABCD"))
+    score = np.round(np.random.random(rows), 3)
+    ucl, lcl = 0.8, 0.1
+    judge = np.where(score > ucl, "NG_over_spec", np.where(score < lcl, "NG_under_spec", "OK"))
+    zipfile = pd.Series([f"data/files\\data_{n}.zip" for n in i])
+    graphpath = pd.Series([f"data/graphs\\data_{n}\\graph.png" for n in i])
+    absolute = i % 10 == 0
+    graphpath[absolute] = [f"C:\\Users\\user\\WebPage\\data\\graphs\\data_{n}\\graph.png" for n in i[absolute]]
+    capital = i % 100 == 1
+    graphpath[capital] = [f"C:\\Users\\user\\WebPage\\Data\\Graphs\\data_{n}\\graph.png" for n in i[capital]]
+    return pd.DataFrame({
+        "no": i,
+        "detect_category": np.char.add("detect", kinds[i % 100 // 25]),
+        "product": np.char.add("product", kinds[(i // 50) % 4]),
+        "test": np.char.add("test_", (i % 100).astype(str)),
+        "score": score,
+        "judge": judge,
+        "ucl": ucl,
+        "lcl": lcl,
+        "zipfile": zipfile,
+        "graphpath": graphpath,
+    })
+
+# -------------------------------------------------
+# benchmarks
+# -------------------------------------------------
+def bench_graphpath(rows:int):
+    """main.py: graphpath / download 列の変換 (行ごとの apply vs ベクトル化)"""
+    import main
+
+    df = make_detection_table(rows)
+    t_old, old = measure(lambda s: s.apply(main.convert_graphpath), df["graphpath"])
+    t_new, new = measure(main.convert_graphpaths, df["graphpath"])
+    assert old.equals(new), "convert_graphpaths の出力が convert_graphpath と一致しません"
+    report("graphpath: apply", t_old)
+    report("graphpath: vectorized", t_new, t_old)
+
+    t_old, old = measure(lambda s: pd.Series([os.path.basename(p) for p in s]), df["zipfile"])
+    t_new, new = measure(main.path_basenames, df["zipfile"])
+    assert old.tolist() == new.tolist(), "path_basenames の出力が os.path.basename と一致しません"
+    report("download: list comprehension", t_old)
+    report("download: vectorized", t_new, t_old)
+
+def _latest_flags_loop(df:pd.DataFrame)->list:
+    """変更前の DataExe.__loadfiles の latest フラグ計算 (比較用)"""
+    flg = {}
+    for k in df["異常検知種"].unique():
+        mindate = df[df["異常検知種"]==k]["更新日"].min()
+        flg[k] = {str(mindate):"●"}
+    latest = []
+    for k, d in zip(df["異常検知種"], df["更新日"]):
+        try:
+            latest.append(flg[k][str(d)])
+        except:
+            latest.append(None)
+    return latest
+
+def make_execute_table(rows:int,
+                       kinds:int=50)->pd.DataFrame:
+    """execute_tble.xlsx と同じ列(異常検知種 / 更新日)を持つ実行テーブルを rows 行作成する"""
+    dates = pd.Timestamp("2024-01-01") + pd.to_timedelta(np.random.randint(0, 365 * 24, rows), unit="h")
+    return pd.DataFrame({
+        "異常検知種": np.char.add("detect", np.random.randint(0, kinds, rows).astype(str)),
+        "更新日": dates,
+    }).sort_values(by="更新日")
+
+def bench_latest(rows:int):
+    """Dataloader.py: DataExe の latest フラグ計算 (ループ vs groupby/transform)"""
+    import Dataloader as D
+
+    df = make_execute_table(rows)
+    t_old, old = measure(_latest_flags_loop, df, repeat=1)
+    t_new, new = measure(D.latest_flags, df["異常検知種"], df["更新日"])
+    assert list(new) == old, "latest_flags の出力が変更前の計算と一致しません"
+    report("latest: loop", t_old)
+    report("latest: groupby/transform", t_new, t_old)
+
+_STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import proto_type3 as p
+result = {"import": time.perf_counter() - start}
+for provider in (p.users, p.exe_provider, p.dataset_provider):
+    start = time.perf_counter()
+    try:
+        provider.get()
+        result[provider.name] = time.perf_counter() - start
+    except Exception as e:
+        result[provider.name] = repr(e)
+print(json.dumps(result))
+"""
+
+def bench_startup(rows:int):
+    """proto_type3.py: ワーカー起動時間 (import のみ vs 変更前と同じくimport時に全て読み込む場合)"""
+    # import のキャッシュが効かないよう、新しいプロセスで計測する (rows は使わない)
+    out = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    t_lazy = result.pop("import")
+    t_eager = t_lazy
+    for name, value in result.items():
+        if isinstance(value, str):
+            print(f"  provider {name:<23}: 読み込めません ({value})")
+            continue
+        report(f"provider {name}", value)
+        t_eager += value
+    report("startup: eager (import + load)", t_eager)
+    report("startup: lazy (import only)", t_lazy, t_eager)
+
+def _figure_json(build, *args, **kwargs)->str:
+    """図を作成し、ブラウザに送るJSONにするまで"""
+    import plotly.io as pio
+    return pio.to_json(build(*args, **kwargs))
+
+def bench_plot(rows:int):
+    """utils.py: トレンド図 / 散布図の作成時間とJSONサイズ (SVG全点 vs WebGL+間引き)"""
+    import utils as u
+
+    # make_dataset.ipynb の1ファイル分 (10,000点) 以上、SVGで描ける程度まで
+    points = max(10_000, min(rows, 200_000))
+    print(f"  points={points}")
+    dates = pd.date_range("2024-01-01", periods=points, freq="min").values
+    values = np.cumsum(np.random.normal(0, 1, points))
+    t_old, old = measure(_figure_json, u.create_trend_plot, dates, values, render_mode="svg")
+    t_new, new = measure(_figure_json, u.create_trend_plot, dates, values, render_mode="webgl", max_points=2000)
+    report(f"trend: svg ({len(old) / 1e6:.2f} MB)", t_old)
+    report(f"trend: webgl+lttb ({len(new) / 1e6:.2f} MB)", t_new, t_old)
+
+    x, y = np.random.normal(0, 1, points), np.random.normal(0, 1, points)
+    category = np.random.choice(["OK", "NG_over_spec", "NG_under_spec"], points)
+    t_old, old = measure(_figure_json, u.create_scatter_plot, x, y, category, render_mode="svg")
+    t_new, new = measure(_figure_json, u.create_scatter_plot, x, y, category, render_mode="webgl", max_points=2000)
+    report(f"scatter: svg ({len(old) / 1e6:.2f} MB)", t_old)
+    report(f"scatter: webgl+grid ({len(new) / 1e6:.2f} MB)", t_new, t_old)
+
+def _split_by_mask(values, category)->list:
+    """変更前の utils.py のカテゴリ分け (カテゴリごとにSeriesとマスクを作り直す, 比較用)"""
+    return [(cat, np.array(values)[pd.Series(category) == cat]) for cat in pd.Series(category).unique()]
+
+def _split_by_group(values, category)->list:
+    import utils as u
+    values = np.asarray(values)
+    return [(cat, values[idx]) for cat, idx in u.group_indices(category)]
+
+def bench_category(rows:int):
+    """utils.py: 散布図・箱ひげ図のカテゴリ分け (カテゴリごとのマスク vs factorize/argsort)"""
+    import utils as u
+
+    values = np.random.normal(0, 1, rows)
+    category = np.char.add("product", np.random.randint(0, 200, rows).astype(str))
+    t_old, old = measure(_split_by_mask, values, category, repeat=1)
+    t_new, new = measure(_split_by_group, values, category)
+    assert all(a[0] == b[0] and np.array_equal(a[1], b[1]) for a, b in zip(old, new)), "カテゴリ分けの結果が一致しません"
+    report("category split: mask", t_old)
+    report("category split: group_indices", t_new, t_old)
+    t_fig, _ = measure(u.create_box_plot, values, category, repeat=1)
+    report("create_box_plot (total)", t_fig)
+
+def bench_box(rows:int):
+    """utils.py: 箱ひげ図の作成時間とJSONサイズ (全データ vs 統計量のみ)"""
+    import utils as u
+
+    values = np.random.normal(0, 1, rows)
+    category = np.char.add("product", np.random.randint(0, 200, rows).astype(str))
+    t_old, old = measure(_figure_json, u.create_box_plot_with_count, values, category, repeat=1)
+    t_new, new = measure(_figure_json, u.create_box_plot_with_count, values, category, summary=True)
+    report(f"box: raw ({len(old) / 1e6:.2f} MB)", t_old)
+    report(f"box: summary ({len(new) / 1e6:.2f} MB)", t_new, t_old)
+
+def _render_many(render, n:int, *args, **kwargs):
+    for _ in range(n):
+        html = render(*args, **kwargs)
+    return html
+
+def bench_templates(rows:int):
+    """main.py: /dashboard・/anomaly/<id> のテンプレート描画 (render_template_string vs DictLoader)"""
+    import main
+    from flask import render_template, render_template_string
+
+    # 1回あたりの時間にするため n 回描画する (rows は使わない)
+    n = 200
+    partition = main.result_store.partition(1)
+    pages = {
+        "dashboard": (main.dashboard_template, "dashboard.html",
+                      {"table_data": main.df_main.to_dict(orient="records")}),
+        "anomaly": (main.anomaly_template, "anomaly.html",
+                    {"anomaly_id": 1, "anomaly_name": "異常検知1: ValueA", "graph_width": main.GRAPH_DISPLAY_WIDTH,
+                     "products": partition.products, "tests": partition.tests}),
+    }
+    with main.app.test_request_context("/"):
+        for page, (source, name, context) in pages.items():
+            t_old, old = measure(_render_many, render_template_string, n, source, **context)
+            t_new, new = measure(_render_many, render_template, n, name, **context)
+            assert old == new, f"{page} の描画結果が一致しません"
+            report(f"{page}: render_template_string", t_old / n)
+            report(f"{page}: render_template", t_new / n, t_old / n)
+
+# import時間を計測するモジュール (アプリの起動時間の大部分)
+IMPORTTIME_MODULES = ["utils", "Dataloader", "app4", "proto_type3", "main"]
+
+def parse_importtime(stderr:str)->list:
+    """
+    python -X importtime の出力を [(階層, 累計時間(秒), モジュール名), ...] にする
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, int(cumulative) / 1e6, name.strip()))
+    return entries
+
+def bench_importtime(rows:int):
+    """各モジュールの import 時間 (python -X importtime、新しいプロセスで計測)"""
+    # rows は使わない
+    for module in IMPORTTIME_MODULES:
+        out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, cwd=os.getcwd(),
+                             env={**os.environ, "PYTHONPATH": os.pathsep.join(
+                                 [os.path.dirname(os.path.abspath(__file__)), os.getcwd()])})
+        if out.returncode != 0:
+            error = out.stderr.strip().splitlines()[-1] if out.stderr.strip() else out.returncode
+            print(f"  {module:<32}: import できません ({error})")
+            continue
+        entries = parse_importtime(out.stderr)
+        # 子モジュールは親より前に出力されるので、直前のトップレベルの行の後ろから module の行までを見る
+        end = next(i for i, (depth, _, name) in enumerate(entries) if depth == 0 and name == module)
+        start = max([i for i, (depth, _, _) in enumerate(entries[:end]) if depth == 0], default=-1) + 1
+        report(module, entries[end][1])
+        # 時間のかかっている直接の import 上位3つ
+        children = sorted((t, name) for depth, t, name in entries[start:end] if depth == 1)[::-1][:3]
+        for t, name in children:
+            report(f"  {name}", t)
+
+BENCHMARKS = {
+    "graphpath": bench_graphpath,
+    "latest": bench_latest,
+    "startup": bench_startup,
+    "plot": bench_plot,
+    "category": bench_category,
+    "box": bench_box,
+    "templates": bench_templates,
+    "importtime": bench_importtime,
+}
+
+# debug
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="webpage benchmarks")
+    parser.add_argument("names", nargs="*", help=f"実行するベンチマーク {list(BENCHMARKS)} (省略時は全て)")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="合成データの行数")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {sorted(unknown)}")
+
+    for name in args.names or BENCHMARKS:
+        print(f"[{name}] rows={args.rows}")
+        BENCHMARKS[name](args.rows)
@@ -0,0 +1,118 @@
+# response compression
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request
+
+# brotliが無い環境ではgzipだけを使う
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# -------------------------------------------------
+# parameters
+# -------------------------------------------------
+# 圧縮するContent-Type (PNGやZIPなど圧縮済みの形式は含めない)
+COMPRESSIBLE_TYPES = (
+    "text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+    "application/json", "application/javascript", "application/x-javascript",
+    "application/xml", "image/svg+xml",
+)
+# これより小さいレスポンスは圧縮しない(byte)
+MIN_SIZE = 500
+# 圧縮済みバイト列のキャッシュの上限(byte)
+CACHE_BYTES = 32 * 1024 * 1024
+
+
+# -------------------------------------------------
+# class
+# -------------------------------------------------
+class Compressor:
+    """
+    Flaskのレスポンスを Accept-Encoding に応じて brotli / gzip で圧縮する
+
+    after_request で本文がメモリ上にあるレスポンスだけを圧縮する。send_file のファイル送信や
+    ストリーミング(ZIPの一括ダウンロードなど)、圧縮済みの形式(PNG/ZIP)はそのまま返す。
+    同じ本文(Dashのjsなど変わらないレスポンス)は、本文のハッシュをキーに圧縮結果を使い回す。
+    """
+
+    def __init__(self,
+                 app=None,
+                 level:int=6,
+                 min_size:int=MIN_SIZE,
+                 cache_bytes:int=CACHE_BYTES)->None:
+        self.level = level
+        self.min_size = min_size
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app)->None:
+        app.after_request(self.after_request)
+
+    def encodings(self)->list:
+        """使える圧縮形式 (優先順)"""
+        return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def choose_encoding(self,)->str:
+        """リクエストの Accept-Encoding から使う圧縮形式を選ぶ (使えない場合はNone)"""
+        for encoding in self.encodings():
+            if request.accept_encodings.quality(encoding) > 0:
+                return encoding
+        return None
+
+    def compress(self,
+                 data:bytes,
+                 encoding:str)->bytes:
+        """data を encoding で圧縮する (同じ本文は前回の結果を返す)"""
+        key = (hashlib.sha1(data).digest(), encoding)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=min(self.level, 11))
+        else:
+            compressed = gzip.compress(data, compresslevel=self.level, mtime=0)
+        with self._lock:
+            if key not in self._cache and len(compressed) <= self.cache_bytes:
+                self._cache[key] = compressed
+                self._cached_bytes += len(compressed)
+                # 古いものから削除する(LRU)
+                while self._cached_bytes > self.cache_bytes:
+                    _, old = self._cache.popitem(last=False)
+                    self._cached_bytes -= len(old)
+        return compressed
+
+    def after_request(self, response):
+        if (response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+                or response.direct_passthrough or response.is_streamed
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+        # 圧縮するかどうかが Accept-Encoding で変わることをキャッシュに伝える
+        response.vary.add("Accept-Encoding")
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        response.set_data(self.compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        # 強いETagはバイト列が同じことを表すので、圧縮後は弱いETagにする
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+            # 弱いETagを送り返されても304を返せるよう、ここで If-None-Match を確認し直す
+            # (DashはIf-None-Matchを強いETagと文字列で比較するので、弱いETagでは一致しない)
+            response.make_conditional(request)
+        return response
@@ -0,0 +1,131 @@
+# columnar cache for csv files
+import os
+import pandas as pd
+
+# pyarrowが無い環境ではキャッシュを使わずにCSVを読み込む
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+
+# -------------------------------------------------
+# functions
+# -------------------------------------------------
+def sidecar_path(path:str)->str:
+    """CSVファイルに対応するキャッシュ(Feather)ファイルのパスを返す"""
+    return path + ".feather"
+
+def file_signature(path:str)->tuple:
+    """ファイルの更新日時(ns)とサイズを返す。キャッシュが有効かどうかの判定に使う"""
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def to_categorical(df:pd.DataFrame,
+                   columns:list=None)->pd.DataFrame:
+    """指定された列のうち、存在する列をcategory型に変換する"""
+    for col in columns or []:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+def restore_object_columns(df:pd.DataFrame,
+                           table)->pd.DataFrame:
+    """
+    保存時にobject型だった列をobject型 (欠損値はNone) に戻す
+
+    pandas 3 ではFeatherの文字列の列はstr型 (欠損値はNaN) で読み込まれるので、
+    読み込み直した場合と同じ型になるよう、保存時の型 (pandasのメタデータ) に合わせる。
+    """
+    columns = (table.schema.pandas_metadata or {}).get("columns", [])
+    for col in columns:
+        name = col.get("name")
+        if col.get("numpy_type") == "object" and name in df.columns and df[name].dtype != object:
+            df[name] = df[name].astype(object).where(df[name].notna(), None)
+    return df
+
+def load_sidecar(path:str,
+                 head:int=None):
+    """
+    キャッシュを読み込む
+
+    キャッシュに記録された元ファイルの更新日時・サイズが現在の元ファイルと一致する場合だけ
+    メモリマップで読み込み、(DataFrame, メタデータの辞書) を返す。
+    キャッシュが無い / 古い / 読めない場合はNoneを返す。
+
+    :param path: 元ファイル(CSV)のパス
+    :param head: 指定した場合は先頭の head 行だけをDataFrameにする
+    """
+    cache = sidecar_path(path)
+    if feather is None or not os.path.exists(cache):
+        return None
+    try:
+        table = feather.read_table(cache, memory_map=True)
+        meta = {k.decode(): v.decode() for k, v in (table.schema.metadata or {}).items()
+                if not k.startswith(b"pandas")}
+        signature = (int(meta["source_mtime_ns"]), int(meta["source_size"]))
+        if signature != file_signature(path):
+            # 元ファイルの方が新しい
+            return None
+        if head is not None:
+            table = table.slice(0, head)
+        return restore_object_columns(table.to_pandas(), table), meta
+    except Exception as e:
+        print(f"エラー: キャッシュ '{cache}' を読み込めません: {e}")
+        return None
+
+def save_sidecar(path:str,
+                 df:pd.DataFrame,
+                 signature:tuple,
+                 meta:dict=None)->None:
+    """
+    DataFrameをキャッシュとして保存する
+
+    :param path: 元ファイル(CSV)のパス
+    :param df: 保存するDataFrame (元ファイルを読み込んだ直後のもの)
+    :param signature: 読み込み前に取得した元ファイルの file_signature()
+    :param meta: 一緒に保存する任意のメタデータ(文字列の辞書)
+    """
+    if feather is None:
+        return
+    cache = sidecar_path(path)
+    tmp = cache + ".tmp"
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata.update({
+            b"source_mtime_ns": str(signature[0]).encode(),
+            b"source_size": str(signature[1]).encode(),
+        })
+        for k, v in (meta or {}).items():
+            metadata[str(k).encode()] = str(v).encode()
+        # メモリマップで読めるよう非圧縮で保存し、書き込み完了後に差し替える
+        feather.write_feather(table.replace_schema_metadata(metadata), tmp, compression="uncompressed")
+        os.replace(tmp, cache)
+    except Exception as e:
+        print(f"エラー: キャッシュ '{cache}' を保存できません: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def read_csv_cached(path:str,
+                    categories:list=None,
+                    **kwargs)->pd.DataFrame:
+    """
+    pd.read_csv のキャッシュ付き版
+
+    初回はCSVを読み込み、categoriesの列をcategory型にしてキャッシュを保存する。
+    2回目以降はキャッシュが元ファイルと一致していればキャッシュから読み込む。
+
+    :param path: CSVファイルのパス
+    :param categories: category型にする列名のリスト
+    :param kwargs: pd.read_csv に渡す引数 (encodingなど)
+    """
+    cached = load_sidecar(path)
+    if cached is not None:
+        return cached[0]
+    signature = file_signature(path)
+    df = to_categorical(pd.read_csv(path, **kwargs), categories)
+    save_sidecar(path, df, signature)
+    return df
@@ -0,0 +1,110 @@
+# resized image cache
+import os
+import hashlib
+import threading
+from PIL import Image
+
+
+# -------------------------------------------------
+# parameters
+# -------------------------------------------------
+# 生成する幅 (要求された幅以上で最小のものに丸める。キャッシュの種類が増えすぎないように)
+ALLOWED_WIDTHS = (200, 400, 800, 1200, 1600, 2000)
+
+
+# -------------------------------------------------
+# class
+# -------------------------------------------------
+class ThumbnailCache:
+    """
+    画像の縮小版をディスク上にキャッシュする
+
+    縮小版は初回要求時に1回だけ作成し、cache_dir に保存する。
+    キャッシュの合計サイズが max_bytes を超えたら、最後に使われた日時(ファイルのmtime)が
+    古いものから削除する(LRU)。キャッシュのキーには元画像の更新日時とサイズを含めるので、
+    元画像が作り直された場合は別のキャッシュとして扱われる。
+    """
+
+    def __init__(self,
+                 cache_dir:str,
+                 max_bytes:int=200 * 1024 * 1024)->None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 現在のキャッシュ合計サイズ
+        self._total = sum(e.stat().st_size for e in os.scandir(self.cache_dir) if e.is_file())
+
+    @staticmethod
+    def round_width(width:int)->int:
+        """要求された幅を ALLOWED_WIDTHS のいずれかに丸める"""
+        for w in ALLOWED_WIDTHS:
+            if width <= w:
+                return w
+        return ALLOWED_WIDTHS[-1]
+
+    def key(self,
+            src_path:str,
+            width:int)->str:
+        """元画像と幅から決まるキャッシュのキー (ETagとしても使う)"""
+        st = os.stat(src_path)
+        raw = f"{os.path.abspath(src_path)}|{st.st_mtime_ns}|{st.st_size}|{width}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self,
+            src_path:str,
+            width:int):
+        """
+        幅 width に縮小した画像を開いて、ファイルオブジェクトとキーを返す
+        (返した後に別スレッドがキャッシュを削除しても読めるよう、開いた状態で返す)
+
+        :param src_path: 元画像のパス
+        :param width: 幅(px)。ALLOWED_WIDTHS に丸められる
+        :return: (縮小画像のファイルオブジェクト, キー)
+        """
+        width = self.round_width(width)
+        key = self.key(src_path, width)
+        path = os.path.join(self.cache_dir, key + ".png")
+        if os.path.exists(path):
+            # LRUのため最終利用日時を更新
+            try:
+                os.utime(path)
+                return open(path, "rb"), key
+            except FileNotFoundError:
+                # 直前に削除された場合は作り直す
+                pass
+
+        # 別名で書き込んでから差し替える (同時に要求された場合も壊れたファイルを返さない)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with Image.open(src_path) as img:
+            if img.width > width:
+                img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+            img.save(tmp, format="PNG", optimize=True)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        f = open(path, "rb")
+        with self._lock:
+            self._total += size
+            self._evict(keep=path)
+        return f, key
+
+    def _evict(self,
+               keep:str)->None:
+        """合計サイズが上限以下になるまで、古いキャッシュから削除する (keepは削除しない)"""
+        if self._total <= self.max_bytes:
+            return
+        entries = sorted(((e.path, e.stat()) for e in os.scandir(self.cache_dir) if e.name.endswith(".png")),
+                         key=lambda x: x[1].st_mtime)
+        # 実際のファイルから合計を数え直す
+        self._total = sum(st.st_size for _, st in entries)
+        for path, st in entries:
+            if self._total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self._total -= st.st_size
+            except OSError:
+                # 削除済み、または配信中で削除できない (Windows)
+                pass
@@ -1,14 +1,29 @@
 import os
+import io
+import re
+import json
+import hashlib
+import zlib
+import threading
 import numpy as np
 import pandas as pd
 from flask import (
-    Flask, render_template_string, request, redirect,
-    url_for, session, send_from_directory
+    Flask, render_template, request, redirect,
+    url_for, session, send_from_directory, send_file, jsonify, Response, abort,
+    make_response
 )
+from jinja2 import DictLoader
+from werkzeug.security import safe_join
 import config as c
+import datacache
+from imagecache import ThumbnailCache
+import zipstream
+from compression import Compressor
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
+# HTML・JSONのレスポンスを圧縮して返す
+Compressor(app)
 
 # ユーザーIDとパスワードを管理
 users = {
@@ -28,13 +43,11 @@ df_main = pd.DataFrame({
     "Value": np.random.randint(100, 200, size=30),
     "Memo": [f"メモ{i}" for i in range(1, 31)]
 })
-
-# 異常検知結果用DataFrameを読み込み
-df_result = pd.read_csv(r"data\detection_tbl.csv", encoding="CP932")
+# df_main の世代 (作り直した場合は1増やす。ダッシュボードのETagに使う)
+df_main_generation = 0
 
 # DetectionType for page
 detection_type = {"detectA": 1, "detectB": 2, "detectC": 3, "detectD": 4}
-df_result["DetectionType"] = df_result["detect_category"].map(detection_type)
 
 def convert_graphpath(old_path: str) -> str:
     """
@@ -80,18 +93,351 @@ def convert_graphpath(old_path: str) -> str:
     # Flask用の絶対パス → "/my_images/data_0/graph.png"
     return f"/my_images/{sub_url}"
 
-# CSVのgraphpathを変換
-df_result["graphpath"] = df_result["graphpath"].apply(convert_graphpath)
+# 先頭から最初の "graphs\\" までの部分
+_GRAPHS_PREFIX = r"^.*?graphs\\"
+# os.path.basename と同じく、最後の区切り文字までを取り除く
+_DIRNAME_PART = "^.*[" + re.escape(os.sep + (os.altsep or "")) + "]"
+
+def convert_graphpaths(paths: pd.Series) -> pd.Series:
+    """
+    convert_graphpath の列単位(ベクトル化)版。出力は convert_graphpath を各行に適用した結果と同じ。
+
+    小文字の "graphs\\" が最初の一致位置にある行(ほぼ全ての行)は文字列演算だけで変換し、
+    "Graphs\\" のように大文字を含む行や "graphs\\" が無い行だけ convert_graphpath で1行ずつ変換する。
+    """
+    keyword = "graphs\\"
+    unified = paths.str.replace("/", "\\", regex=False)
+    idx = unified.str.lower().str.find(keyword)
+    fast = (unified.str.find(keyword) == idx) & (idx != -1)
+
+    subpart = unified.str.replace(_GRAPHS_PREFIX, "", regex=True)
+    converted = "/my_images/" + subpart.str.replace("\\", "/", regex=False)
+    if not fast.all():
+        converted = converted.where(fast, paths[~fast].map(convert_graphpath))
+    return converted
+
+def path_basenames(paths: pd.Series) -> pd.Series:
+    """os.path.basename を各行に適用した結果と同じ列を返す"""
+    return paths.str.replace(_DIRNAME_PART, "", regex=True)
+
+# 異常検知結果CSVのパス
+RESULT_CSV_PATH = r"data\detection_tbl.csv"
+# キャッシュ保存時にcategory型にする列
+RESULT_CATEGORY_COLUMNS = ["detect_category", "product", "test", "judge"]
+
+def transform_result_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    CSVから読み込んだ検知結果を画面表示用の形に変換する
+    (DetectionType付与 / graphpath変換 / download列の作成 / 列の並び替え)
+    """
+    df = df.copy()
+    df["DetectionType"] = df["detect_category"].map(detection_type)
+
+    # CSVのgraphpathを変換
+    df["graphpath"] = convert_graphpaths(df["graphpath"])
+
+    # ZIPファイルの列名を変更
+    df.rename(columns={"zipfile": "download"}, inplace=True)
+    df["download"] = path_basenames(df["download"])
+
+    # 列の並びを再定義
+    return df[[
+        "no","DetectionType","product","test","score","judge",
+        "lcl","ucl","download","graphpath"
+    ]]
+
+#####################################
+# 検知結果テーブルのサーバー側ページング
+#####################################
+
+# APIで返す列 / キーワード検索の対象列
+RESULT_COLUMNS = ["no","product","test","score","judge","lcl","ucl","download","graphpath"]
+SEARCH_COLUMNS = ["no","product","test","score","judge","lcl","ucl","download"]
+# 1ページあたりの最大行数
+MAX_PAGE_SIZE = 500
+
+def _row_json(frame: pd.DataFrame) -> list:
+    """APIで返す列を行ごとにJSON文字列にする (NaNはJSONで扱えないのでnull)"""
+    records = frame[RESULT_COLUMNS]
+    records = records.astype(object).where(records.notna(), None).to_dict(orient="records")
+    return [json.dumps(r, ensure_ascii=False) for r in records]
+
+def _search_text(frame: pd.DataFrame) -> pd.Series:
+    """キーワード検索用に、検索対象の列を文字列として連結し小文字化する"""
+    text = frame[SEARCH_COLUMNS[0]].astype(str)
+    for col in SEARCH_COLUMNS[1:]:
+        text = text + "\t" + frame[col].astype(str)
+    return text.str.lower().reset_index(drop=True)
+
+class ResultPartition:
+    """
+    1つのDetectionTypeに属する検知結果と、APIで使う前計算済みの値をまとめたもの
+
+    データは読み込み後に変化しないので、リクエストごとの絞り込みやJSON化を避けるため
+    - 行ごとのJSON文字列
+    - キーワード検索用の小文字化済みテキスト
+    - ドロップダウン用の製品群 / 目的変数一覧
+    を作成時に1回だけ計算しておく。ソート順は初回に要求された時点で計算してキャッシュする。
+    """
+
+    def __init__(self,
+                 frame: pd.DataFrame,
+                 row_json: list = None,
+                 search_text: pd.Series = None) -> None:
+        self.frame = frame.reset_index(drop=True)
+        self.row_json = _row_json(self.frame) if row_json is None else row_json
+        self.search_text = _search_text(self.frame) if search_text is None else search_text
+
+        # ドロップダウン用 (出現順)
+        self.products = self.frame["product"].unique().tolist()
+        self.tests = self.frame["test"].unique().tolist()
+
+        # (列名, 昇順/降順) → 行番号の並び
+        self._sort_orders = {}
+
+    def appended(self, new_rows: pd.DataFrame) -> "ResultPartition":
+        """
+        行を追加した新しいパーティションを返す
+        既存行のJSON / 検索テキストは再計算せず、追加分だけ計算する
+        """
+        return ResultPartition(
+            pd.concat([self.frame, new_rows], ignore_index=True),
+            row_json=self.row_json + _row_json(new_rows),
+            search_text=pd.concat([self.search_text, _search_text(new_rows)], ignore_index=True)
+        )
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def sort_order(self, column: str, ascending: bool = True) -> np.ndarray:
+        """指定列でソートしたときの行番号の並びを返す (同値の並びは元の順序を保つ)"""
+        key = (column, ascending)
+        order = self._sort_orders.get(key)
+        if order is None:
+            order = self.frame[column].sort_values(ascending=ascending, kind="mergesort").index.to_numpy()
+            self._sort_orders[key] = order
+        return order
+
+    def select(self,
+               sort: str = None,
+               order: str = "asc",
+               q: str = "",
+               filters: dict = None) -> np.ndarray:
+        """
+        条件に合う行番号を表示順に並べて返す
+
+        Parameters:
+        - sort: ソートする列名 (RESULT_COLUMNS以外は無視)
+        - order: "asc" または "desc"
+        - q: キーワード (SEARCH_COLUMNSのいずれかに部分一致する行を残す、大文字小文字は区別しない)
+        - filters: {"product": ..., "test": ..., "judge": ...} の完全一致条件
+        """
+        mask = np.ones(len(self.frame), dtype=bool)
+        # 完全一致の絞り込み
+        for col, value in (filters or {}).items():
+            mask &= (self.frame[col].astype(str) == str(value)).to_numpy()
+        # キーワード検索
+        if q:
+            mask &= self.search_text.str.contains(q.lower(), regex=False).to_numpy()
+
+        if sort in RESULT_COLUMNS:
+            positions = self.sort_order(sort, ascending=(order != "desc"))
+            return positions[mask[positions]]
+        return np.flatnonzero(mask)
+
+    def page_json(self, positions: np.ndarray, page: int, size: int) -> str:
+        """選択済みの行番号から指定ページ分の行をJSON配列の文字列にする"""
+        start = (page - 1) * size
+        return "[" + ",".join(self.row_json[i] for i in positions[start:start + size]) + "]"
 
-# ZIPファイルの列名を変更
-df_result.rename(columns={"zipfile": "download"}, inplace=True)
-df_result["download"] = [os.path.basename(p) for p in df_result["download"]]
+# 読み込み済みの最後の行のチェックサムを取るときに読む長さの上限(byte)
+LAST_LINE_WINDOW = 64 * 1024
 
-# 列の並びを再定義
-df_result = df_result[[
-    "no","DetectionType","product","test","score","judge",
-    "lcl","ucl","download","graphpath"
-]]
+class ResultStore:
+    """
+    検知結果CSVを読み込み、DetectionType → ResultPartition の索引を保持する
+
+    索引は読み込み時に1回だけ作成し、CSVの更新日時またはサイズが変わったときだけ更新する。
+    CSVは末尾に行が追記されていく (no列は単調増加) 前提なので、更新時は前回読み込んだ
+    位置以降の行だけを読み込んで変換し、該当するパーティションに追加する。
+    追記ではない変更 (ファイルの縮小、読み込み済みの最後の行の変化、noの巻き戻り) を検知した場合は
+    全体を読み込み直す。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._offset = 0        # 読み込み済みのバイト数 (行の区切り位置)
+        self._last_line = (0, 0, True)  # 読み込み済みの最後の行 (長さ, CRC32, 改行で終わっているか)
+        self._pending = None    # 最後の行を次回に回したときのファイルの状態
+        self._columns = None    # CSVのヘッダー
+        self._watcher = None
+        self._stop = threading.Event()
+        self.frame = None
+        self.partitions = {}
+        self.generation = 0     # データを差し替えるたびに増える (ETagに使う)
+        self.reload()
+
+    def _stat_signature(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read_from(self, offset: int) -> bytes:
+        """offset以降をファイルの末尾まで読み込む"""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read()
+
+    def _line_before(self, offset: int) -> bytes:
+        """offset直前の1行 (末尾の改行を含む) を返す"""
+        start = max(0, offset - LAST_LINE_WINDOW)
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read(offset - start)
+        body = data[:-1] if data.endswith(b"\n") else data
+        return data[body.rfind(b"\n") + 1:]
+
+    def _last_line_matches(self) -> bool:
+        """読み込み済みの最後の行が前回から変わっていないか (チェックサムで比較する)"""
+        length, checksum, _ = self._last_line
+        if length > self._offset:
+            return False
+        with open(self.path, "rb") as f:
+            f.seek(self._offset - length)
+            data = f.read(length)
+        return len(data) == length and zlib.crc32(data) == checksum
+
+    def _swap(self, frame, partitions, signature, offset) -> None:
+        # 参照中のリクエストに影響しないよう、作り終えてから差し替える
+        self.frame, self.partitions = frame, partitions
+        self._signature, self._offset = signature, offset
+        # 次回の追記読み込みで、読み込み済みの部分が書き換えられていないかを確認するために覚えておく
+        line = self._line_before(offset)
+        self._last_line = (len(line), zlib.crc32(line), line.endswith(b"\n"))
+        self.generation += 1
+
+    def reload(self) -> None:
+        """CSV全体を読み込み直してパーティションを作り直す"""
+        with self._lock:
+            self._reload()
+
+    def _reload(self) -> None:
+        signature = self._stat_signature()
+        cached = datacache.load_sidecar(self.path)
+        if cached is not None and int(cached[1]["offset"]) == signature[1]:
+            # CSVが前回から変わっていなければ、パース済みのキャッシュを使う
+            # (最後の行まで読み込んだキャッシュだけを使う)
+            raw, meta = cached
+            offset = int(meta["offset"])
+        else:
+            # 改行で終わっていない最後の行も読み込む (書き足された場合はrefreshで検知して読み込み直す)
+            data = self._read_from(0)
+            raw = pd.read_csv(io.BytesIO(data), encoding="CP932")
+            raw = datacache.to_categorical(raw, RESULT_CATEGORY_COLUMNS)
+            offset = len(data)
+            datacache.save_sidecar(self.path, raw, signature, meta={"offset": offset})
+        self._columns = list(raw.columns)
+        frame = transform_result_table(raw)
+        partitions = {
+            key: ResultPartition(group)
+            for key, group in frame.groupby("DetectionType", sort=False, observed=True)
+        }
+        self._pending = None
+        self._swap(frame, partitions, signature, offset)
+
+    def refresh(self) -> None:
+        """CSVが更新されていれば、追記された行だけを読み込んで反映する"""
+        with self._lock:
+            signature = self._stat_signature()
+            if signature == self._signature:
+                return
+            if signature[1] < self._offset or not self._last_line_matches():
+                # ファイルが小さくなった、または読み込み済みの部分が書き換えられた → 全体を読み込み直す
+                self._reload()
+                return
+
+            data = self._read_from(self._offset)
+            if not self._last_line[2] and data[:1] not in (b"\n", b"\r"):
+                # 改行で終わっていなかった最後の行に書き足された → 全体を読み込み直す
+                self._reload()
+                return
+            end = data.rfind(b"\n") + 1
+            if end < len(data) and signature != self._pending:
+                # 改行で終わっていない最後の行は書き込み途中の可能性があるので次回に回す
+                # (次回もファイルが変わっていなければ、書き込みが終わったとみなして読み込む)
+                data, pending = data[:end], signature
+            else:
+                pending = None
+            self._pending = pending
+            if not data.strip():
+                if pending is None:
+                    self._signature = signature
+                return
+            try:
+                raw = pd.read_csv(io.BytesIO(data), encoding="CP932",
+                                  header=None, names=self._columns)
+                rewound = len(self.frame) > 0 and raw["no"].min() <= self.frame["no"].max()
+            except Exception as e:
+                print(f"エラー: {self.path} の追記された行を読み込めません ({e})。全体を読み込み直します")
+                rewound = True
+            if rewound:
+                # noが巻き戻っている、または読み込めない → 追記ではないので全体を読み込み直す
+                self._reload()
+                return
+
+            new_rows = transform_result_table(raw)
+            partitions = dict(self.partitions)
+            for key, group in new_rows.groupby("DetectionType", sort=False, observed=True):
+                if key in partitions:
+                    partitions[key] = partitions[key].appended(group)
+                else:
+                    partitions[key] = ResultPartition(group)
+            frame = pd.concat([self.frame, new_rows], ignore_index=True)
+            # 最後の行を次回に回した場合は、ファイルが変わっていなくても次回もう一度確認する
+            self._swap(frame, partitions, None if pending else signature, self._offset + len(data))
+            print(f"{self.path}: {len(new_rows)} rows appended")
+
+    def start_watcher(self, interval: float = 5.0) -> None:
+        """CSVの更新をinterval秒ごとに確認するバックグラウンドスレッドを開始する"""
+        if self._watcher is not None:
+            return
+
+        def watch():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"エラー: {self.path} の再読み込みに失敗しました: {e}")
+
+        self._watcher = threading.Thread(target=watch, name="result-store-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self) -> None:
+        self._stop.set()
+
+    def partition(self, detection_type: int) -> ResultPartition:
+        """DetectionTypeのパーティションを返す (該当なしの場合は空)"""
+        partition = self.partitions.get(detection_type)
+        if partition is None:
+            partition = ResultPartition(self.frame.iloc[:0])
+        return partition
+
+# 異常検知結果を読み込み、以降はCSVの追記をバックグラウンドで反映する
+RESULT_WATCH_INTERVAL = 5.0
+result_store = ResultStore(RESULT_CSV_PATH)
+result_store.start_watcher(RESULT_WATCH_INTERVAL)
+
+#####################################
+# グラフ画像の縮小版
+#####################################
+
+# 異常検知ページで表示するグラフの幅(px)
+GRAPH_DISPLAY_WIDTH = 1200
+# 縮小版のキャッシュ (上限200MB)
+THUMBNAIL_CACHE_DIR = os.path.join(c.ROOT, r"data\graphs_cache")
+THUMBNAIL_CACHE_BYTES = 200 * 1024 * 1024
+thumbnails = ThumbnailCache(THUMBNAIL_CACHE_DIR, max_bytes=THUMBNAIL_CACHE_BYTES)
 
 #####################################
 # テンプレート
@@ -315,53 +661,49 @@ anomaly_template = """
                 </div>
                 <div>
                     <button onclick="showGraph()">表示</button>
+                    <button onclick="bulkDownload({product: productSelect.value, test: testSelect.value})">ZIPをまとめてダウンロード</button>
                 </div>
             </div>
 
             <!-- 右カラム(グラフ表示エリア) -->
             <div style="flex-grow: 1;">
                 <div class="graph-area">
-                    <img id="graph-display" src="" alt="グラフ" style="max-width: 2000px; display: block;">
+                    <!-- 縮小版を表示し、クリックで元サイズの画像を開く -->
+                    <a id="graph-link" href="" target="_blank">
+                        <img id="graph-display" src="" alt="グラフ" style="max-width: 2000px; display: block;">
+                    </a>
                 </div>
             </div>
         </div>
 
         <h2>検知結果</h2>
         <input type="text" id="filter-input" placeholder="検索キーワードを入力" onkeyup="filterTable()">
+        <div class="dropdown">
+            <label>judge: </label>
+            <select id="judge-filter" onchange="filterTable()">
+                <option value="">すべて</option>
+                <option value="OK">OK</option>
+                <option value="NG_over_spec">NG_over_spec</option>
+                <option value="NG_under_spec">NG_under_spec</option>
+            </select>
+            <!-- 現在の検索条件に一致する全行のZIPを1つにまとめてダウンロード -->
+            <button onclick="bulkDownload({q: keyword, judge: judgeFilter})">検索結果のZIPをまとめてダウンロード</button>
+        </div>
         <div class="table-container">
             <table class="result-table" id="result-table">
                 <thead>
                     <tr>
-                        <th class="sortable" onclick="sortTable(0)">no</th>
-                        <th class="sortable" onclick="sortTable(1)">product</th>
-                        <th class="sortable" onclick="sortTable(2)">test</th>
-                        <th class="sortable" onclick="sortTable(3)">score</th>
-                        <th class="sortable" onclick="sortTable(4)">judge</th>
-                        <th class="sortable" onclick="sortTable(5)">lcl</th>
-                        <th class="sortable" onclick="sortTable(6)">ucl</th>
+                        <th class="sortable" onclick="sortTable('no')">no</th>
+                        <th class="sortable" onclick="sortTable('product')">product</th>
+                        <th class="sortable" onclick="sortTable('test')">test</th>
+                        <th class="sortable" onclick="sortTable('score')">score</th>
+                        <th class="sortable" onclick="sortTable('judge')">judge</th>
+                        <th class="sortable" onclick="sortTable('lcl')">lcl</th>
+                        <th class="sortable" onclick="sortTable('ucl')">ucl</th>
                         <th>Download</th>
                     </tr>
                 </thead>
-                <tbody>
-                    {% for row in table_data %}
-                    <tr>
-                        <td>{{ row["no"] }}</td>
-                        <td>{{ row["product"] }}</td>
-                        <td>{{ row["test"] }}</td>
-                        <td>{{ row["score"] }}</td>
-                        {% if row["judge"] == "NG_over_spec" %}
-                            <td style="background-color: blue; color: white;">{{ row["judge"] }}</td>
-                        {% elif row["judge"] == "NG_under_spec" %}
-                            <td style="background-color: red; color: white;">{{ row["judge"] }}</td>
-                        {% else %}
-                            <td>{{ row["judge"] }}</td>
-                        {% endif %}
-                        <td>{{ row["lcl"] }}</td>
-                        <td>{{ row["ucl"] }}</td>
-                        <td>{{ row["download"]|safe }}</td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
+                <tbody></tbody>
             </table>
         </div>
         <div class="pagination">
@@ -372,17 +714,13 @@ anomaly_template = """
     </div>
 
     <script>
-        let anomalyData = {{ table_data|tojson }};
-
-        // 製品群 / 目的変数 のユニーク値を取得し、ドロップダウンへ
-        let productSet = new Set();
-        let testSet = new Set();
-        anomalyData.forEach(row => {
-            productSet.add(row.product);
-            testSet.add(row.test);
-        });
-        let productList = Array.from(productSet);
-        let testList = Array.from(testSet);
+        // 検知結果はページ単位でサーバーから取得する
+        let rowsUrl = "{{ url_for('anomaly_rows', anomaly_id=anomaly_id) }}";
+        let bulkUrl = "{{ url_for('bulk_download', anomaly_id=anomaly_id) }}";
+
+        // 製品群 / 目的変数 のユニーク値はサーバー側で集計済み
+        let productList = {{ products|tojson }};
+        let testList = {{ tests|tojson }};
 
         let productSelect = document.getElementById("product-select");
         let testSelect = document.getElementById("test-select");
@@ -400,51 +738,101 @@ anomaly_template = """
             testSelect.appendChild(opt);
         });
 
+        function fetchRows(params) {
+            let query = new URLSearchParams(params);
+            return fetch(`${rowsUrl}?${query.toString()}`).then(res => res.json());
+        }
+
         function showGraph() {
-            let selectedProduct = productSelect.value;
-            let selectedTest = testSelect.value;
             let imgElem = document.getElementById("graph-display");
-
-            let row = anomalyData.find(r => r.product === selectedProduct && r.test === selectedTest);
-            if (row) {
-                // row.graphpathが "/my_images/data_0/graph.png" などになっている想定
-                imgElem.src = row.graphpath;
-            } else {
-                imgElem.src = "";
-            }
+            let linkElem = document.getElementById("graph-link");
+            fetchRows({product: productSelect.value, test: testSelect.value, size: 1}).then(data => {
+                // graphpathが "/my_images/data_0/graph.png" などになっている想定
+                let graphpath = (data.rows.length > 0) ? data.rows[0].graphpath : "";
+                imgElem.src = graphpath ? `${graphpath}?w={{ graph_width }}` : "";
+                linkElem.href = graphpath;
+            });
         }
 
-        // テーブルのフィルタ & ページング & ソート
+        // テーブルのフィルタ & ページング & ソート (サーバー側で処理)
         let rowsPerPage = 25;
         let currentPage = 1;
+        let totalRows = 0;
+        let sortColumn = "";
+        let sortOrder = "asc";
+        let keyword = "";
+        let judgeFilter = "";
+        let filterTimer = null;
         let tableBody = document.querySelector("#result-table tbody");
-        let allRows = Array.from(tableBody.getElementsByTagName("tr"));
-        let filteredRows = [...allRows];
 
-        function applyAllFilters() {
-            let keyword = document.getElementById("filter-input").value.toLowerCase();
-            filteredRows = allRows.filter(row => {
-                return row.textContent.toLowerCase().includes(keyword);
-            });
-            currentPage = 1;
-            updateTable();
+        function makeCell(text) {
+            let td = document.createElement("td");
+            td.textContent = (text === null || text === undefined) ? "" : text;
+            return td;
         }
-        function filterTable() {
-            applyAllFilters();
+
+        function renderRows(rows) {
+            tableBody.innerHTML = "";
+            rows.forEach(row => {
+                let tr = document.createElement("tr");
+                ["no", "product", "test", "score"].forEach(col => tr.appendChild(makeCell(row[col])));
+                let judgeCell = makeCell(row.judge);
+                if (row.judge === "NG_over_spec") {
+                    judgeCell.style.backgroundColor = "blue";
+                    judgeCell.style.color = "white";
+                } else if (row.judge === "NG_under_spec") {
+                    judgeCell.style.backgroundColor = "red";
+                    judgeCell.style.color = "white";
+                }
+                tr.appendChild(judgeCell);
+                ["lcl", "ucl"].forEach(col => tr.appendChild(makeCell(row[col])));
+                let linkCell = document.createElement("td");
+                let link = document.createElement("a");
+                link.href = `/download/${encodeURIComponent(row.download)}`;
+                link.textContent = "ダウンロード";
+                linkCell.appendChild(link);
+                tr.appendChild(linkCell);
+                tableBody.appendChild(tr);
+            });
         }
 
         function updateTable() {
-            tableBody.innerHTML = "";
-            let start = (currentPage - 1) * rowsPerPage;
-            let end = start + rowsPerPage;
-            let rowsToShow = filteredRows.slice(start, end);
-            rowsToShow.forEach(row => tableBody.appendChild(row));
-            document.getElementById("page-info").innerText =
-                `ページ ${currentPage} / ${Math.max(1, Math.ceil(filteredRows.length / rowsPerPage))}`;
+            let params = {page: currentPage, size: rowsPerPage, q: keyword};
+            if (judgeFilter) {
+                params.judge = judgeFilter;
+            }
+            if (sortColumn) {
+                params.sort = sortColumn;
+                params.order = sortOrder;
+            }
+            fetchRows(params).then(data => {
+                totalRows = data.total;
+                renderRows(data.rows);
+                document.getElementById("page-info").innerText =
+                    `ページ ${currentPage} / ${Math.max(1, Math.ceil(totalRows / rowsPerPage))}`;
+            });
+        }
+
+        function bulkDownload(params) {
+            // 空の条件は送らない
+            let query = new URLSearchParams();
+            Object.entries(params).forEach(([k, v]) => { if (v) query.append(k, v); });
+            window.location.href = `${bulkUrl}?${query.toString()}`;
+        }
+
+        function filterTable() {
+            // 入力のたびにリクエストしないよう少し待ってから検索
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(() => {
+                keyword = document.getElementById("filter-input").value;
+                judgeFilter = document.getElementById("judge-filter").value;
+                currentPage = 1;
+                updateTable();
+            }, 300);
         }
 
         function nextPage() {
-            if (currentPage * rowsPerPage < filteredRows.length) {
+            if (currentPage * rowsPerPage < totalRows) {
                 currentPage++;
                 updateTable();
             }
@@ -456,20 +844,14 @@ anomaly_template = """
             }
         }
 
-        function sortTable(colIndex) {
-            if (filteredRows.length === 0) return;
-            let firstRowValue = filteredRows[0].getElementsByTagName("td")[colIndex].innerText.trim();
-            let isNumber = !isNaN(parseFloat(firstRowValue));
-
-            filteredRows.sort((a, b) => {
-                let aVal = a.getElementsByTagName("td")[colIndex].innerText.trim();
-                let bVal = b.getElementsByTagName("td")[colIndex].innerText.trim();
-                if(isNumber) {
-                    return parseFloat(aVal) - parseFloat(bVal);
-                } else {
-                    return aVal.localeCompare(bVal, 'ja');
-                }
-            });
+        function sortTable(column) {
+            // 同じ列を再度クリックした場合は昇順/降順を切り替える
+            if (sortColumn === column) {
+                sortOrder = (sortOrder === "asc") ? "desc" : "asc";
+            } else {
+                sortColumn = column;
+                sortOrder = "asc";
+            }
             currentPage = 1;
             updateTable();
         }
@@ -480,6 +862,39 @@ anomaly_template = """
 </html>
 """
 
+# テンプレートは名前で読み込み、初回の描画時に1回だけコンパイルする (以降はJinjaのキャッシュを使う)
+app.jinja_loader = DictLoader({
+    "login.html": login_template,
+    "dashboard.html": dashboard_template,
+    "anomaly.html": anomaly_template,
+})
+
+#####################################
+# ETag (変わっていないページを送り直さない)
+#####################################
+
+# 起動ごとに変わる値 (再起動でデータやテンプレートが変わった場合に、前回のETagと一致しないように)
+BOOT_ID = os.urandom(8).hex()
+
+def page_etag(*parts) -> str:
+    """データの世代と画面の条件(ページ・ソートなど)からETagを作る"""
+    raw = "|".join(str(p) for p in (BOOT_ID, *parts))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def cached_page(etag: str, render):
+    """
+    If-None-Match が etag と一致する場合は描画せずに304を返し、
+    それ以外は render() の結果にETagを付けて返す
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag, weak=True)
+    # ブラウザには毎回確認させる (ログインユーザー向けなので共有キャッシュには置かせない)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
 #####################################
 # Flaskルーティング
 #####################################
@@ -495,14 +910,15 @@ def login():
             return redirect(url_for("dashboard"))
         else:
             error = "ユーザーIDまたはパスワードが違います。"
-    return render_template_string(login_template, error=error)
+    return render_template("login.html", error=error)
 
 @app.route("/dashboard")
 def dashboard():
     if not session.get("logged_in"):
         return redirect(url_for("login"))
-    table_data = df_main.to_dict(orient="records")
-    return render_template_string(dashboard_template, table_data=table_data)
+    return cached_page(
+        page_etag("dashboard", df_main_generation),
+        lambda: render_template("dashboard.html", table_data=df_main.to_dict(orient="records")))
 
 @app.route("/anomaly/<int:anomaly_id>")
 def anomaly_page(anomaly_id):
@@ -520,15 +936,46 @@ def anomaly_page(anomaly_id):
     else:
         anomaly_name = f"異常検知{anomaly_id}: 未定義"
 
-    df_slice = df_result[df_result["DetectionType"] == anomaly_id].copy()
-    df_slice["download"] = df_slice["download"].apply(
-        lambda x: f'<a href="/download/{x}">ダウンロード</a>'
-    )
+    # テーブルの行はAPIからページ単位で取得するので、ここではドロップダウン用の値だけ渡す
+    # データが変わっていなければ描画しない (世代は partition より先に読む)
+    etag = page_etag("anomaly", anomaly_id, result_store.generation, GRAPH_DISPLAY_WIDTH)
+    def render():
+        partition = result_store.partition(anomaly_id)
+        return render_template("anomaly.html",
+                               anomaly_id=anomaly_id,
+                               anomaly_name=anomaly_name,
+                               graph_width=GRAPH_DISPLAY_WIDTH,
+                               products=partition.products,
+                               tests=partition.tests)
+    return cached_page(etag, render)
+
+# 検知結果テーブルのページ取得API
+# 例: /api/anomaly/1/rows?page=2&size=25&sort=score&order=desc&q=product
+@app.route("/api/anomaly/<int:anomaly_id>/rows")
+def anomaly_rows(anomaly_id):
+    if not session.get("logged_in"):
+        return jsonify({"error": "login required"}), 401
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    size = min(max(request.args.get("size", 25, type=int), 1), MAX_PAGE_SIZE)
+    filters = {
+        col: request.args[col]
+        for col in ("product", "test", "judge") if request.args.get(col)
+    }
 
-    table_data = df_slice.to_dict(orient="records")
-    return render_template_string(anomaly_template,
-                                 anomaly_name=anomaly_name,
-                                 table_data=table_data)
+    sort = request.args.get("sort")
+    order = request.args.get("order", "asc")
+    q = request.args.get("q", "")
+    etag = page_etag("rows", anomaly_id, result_store.generation,
+                     page, size, sort, order, q, sorted(filters.items()))
+    def render():
+        partition = result_store.partition(anomaly_id)
+        positions = partition.select(sort=sort, order=order, q=q, filters=filters)
+        # 行は前計算済みのJSON文字列をつなげるだけ
+        body = (f'{{"rows":{partition.page_json(positions, page, size)},'
+                f'"total":{len(positions)},"page":{page},"size":{size}}}')
+        return Response(body, mimetype="application/json")
+    return cached_page(etag, render)
 
 # ZIPファイルのダウンロード
 @app.route("/download/<path:filename>")
@@ -536,11 +983,50 @@ def download_file(filename):
     src_dir = os.path.join(c.ROOT, r"data\files")
     return send_from_directory(directory=src_dir, path=filename, as_attachment=True)
 
+# 条件に一致する行のZIPファイルを1つのZIPにまとめてダウンロード
+# 例: /anomaly/1/bulk_download?product=productA&judge=NG_over_spec
+#     (条件は /api/anomaly/<id>/rows と同じ q / product / test / judge)
+@app.route("/anomaly/<int:anomaly_id>/bulk_download")
+def bulk_download(anomaly_id):
+    if not session.get("logged_in"):
+        return redirect(url_for("login"))
+
+    filters = {
+        col: request.args[col]
+        for col in ("product", "test", "judge") if request.args.get(col)
+    }
+    partition = result_store.partition(anomaly_id)
+    positions = partition.select(q=request.args.get("q", ""), filters=filters)
+
+    # 実在するファイルの (パス, ファイル名) だけを先に集める (パスだけなのでメモリはほぼ使わない)
+    src_dir = os.path.join(c.ROOT, r"data\files")
+    names = partition.frame["download"].to_numpy()[positions]
+    members = list(zipstream.existing_members(os.path.join(src_dir, name) for name in names))
+    if not members:
+        abort(404)
+
+    # ZIPはディスクにもメモリにも作らず、作りながらそのまま送る
+    response = Response(zipstream.iter_zip(members), mimetype="application/zip")
+    response.headers.set("Content-Disposition", "attachment",
+                         filename=f"detection{anomaly_id}_{len(members)}files.zip")
+    return response
+
 # 画像ファイルを配信
+# ?w=800 のように幅を指定すると縮小版を返す (縮小版はディスクにキャッシュ)
 @app.route("/my_images/<path:filename>")
 def serve_my_images(filename):
     image_dir = os.path.join(c.ROOT, r"data\graphs")
-    return send_from_directory(image_dir, filename)
+    width = request.args.get("w", type=int)
+    if not width or width <= 0:
+        return send_from_directory(image_dir, filename)
+
+    src_path = safe_join(image_dir, filename)
+    if src_path is None or not os.path.isfile(src_path):
+        abort(404)
+    f, key = thumbnails.get(src_path, width)
+    # URLは元画像が更新されても変わらないので、ブラウザには毎回確認させる (no-cache)。
+    # キーは元画像の更新日時を含むので、ETagにすれば変わっていない場合は304を返せる
+    return send_file(f, mimetype="image/png", etag=key, conditional=True, max_age=0)
 
 if __name__ == "__main__":
     app.run(host="192.168.0.49", port=5000, debug=True)
@@ -3,11 +3,14 @@ from dash import dcc, html, dash_table
 from dash.dependencies import Input, Output, State
 from flask import Flask, session, redirect
 import bcrypt
-import plotly.express as px
+import numpy as np
 import pandas as pd
 import os
+import threading
+import functools
 import Dataloader as D
 import utils as u
+from compression import Compressor
 
 # -------------------------------------
 # Flask
@@ -15,12 +18,76 @@ server = Flask(__name__)
 server.secret_key = os.urandom(24)
 server.config['SESSION_PERMANENT'] = False
 server.config['SESSION_TYPE'] = 'filesystem'
+# Dashのjs・レイアウト・コールバックのレスポンスを圧縮して返す
+Compressor(server)
+
+# -------------------------------------
+# lazy provider
+class LazyProvider:
+    """
+    初回に使われた時に1回だけ factory() を呼んで作成し、以降は同じものを返す
+
+    import時にExcel/CSVの読み込みやbcryptのハッシュ計算をしないので、ワーカーの起動が速く、
+    データを使わないページ(ログイン画面など)ではデータを読み込まない。
+    reset() で次回 get() 時に作り直す。version は作成した回数で、作り直すと増える。
+    """
+
+    def __init__(self,
+                 factory,
+                 name:str)->None:
+        self.factory = factory
+        self.name = name
+        self.version = 0
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded = False
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self.factory()
+                    self._loaded = True
+                    self.version += 1
+        return self._value
+
+    def warm(self)->None:
+        """バックグラウンドで作成しておく"""
+        threading.Thread(target=self.get, name=f"warm-{self.name}", daemon=True).start()
+
+    def reset(self)->None:
+        with self._lock:
+            self._value = None
+            self._loaded = False
+
+def memoize_layout(*providers):
+    """
+    レイアウトを作る関数の結果をキャッシュするデコレーター
+
+    providers の version が変わらない間(データを読み込み直すまで)は、作成済みのレイアウトを
+    そのまま返すので、ページ遷移のたびにDataFrameの変換(to_dictなど)をやり直さない。
+    """
+    def decorator(build):
+        cache = {}
+        @functools.wraps(build)
+        def wrapper():
+            for provider in providers:
+                provider.get()
+            key = tuple(provider.version for provider in providers)
+            if cache.get("key") != key or "layout" not in cache:
+                cache["layout"] = build()
+                cache["key"] = key
+            return cache["layout"]
+        return wrapper
+    return decorator
 
 # -------------------------------------
 # user data
-users = {
-    "admin": bcrypt.hashpw("pass123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
-}
+def load_users()->dict:
+    return {
+        "admin": bcrypt.hashpw("pass123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+    }
+users = LazyProvider(load_users, "users")
 
 # -------------------------------------
 # Dash app
@@ -35,6 +102,7 @@ app.layout = html.Div([
 
 # -------------------------------------
 # 1. Login
+@memoize_layout()
 def login_layout():
     return html.Div([
         html.H2("Enter user name and password"),
@@ -58,7 +126,8 @@ def login_layout():
     prevent_initial_call=True
 )
 def handle_login(n_clicks, username, password):
-    if username in users and bcrypt.checkpw(password.encode('utf-8'), users[username].encode('utf-8')):
+    hashed = users.get().get(username)
+    if hashed is not None and bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8')):
         session['user'] = username
         return "Success", True, "/"
     return "Failed login", False, "/login"
@@ -77,10 +146,11 @@ def logout(n_clicks):
 # Home page
 # -------------------------------------
 # Dataset
-Data = D.DataExe()
-exedata = Data.exe_tble
+exe_provider = LazyProvider(D.DataExe, "exe")
 
+@memoize_layout(exe_provider)
 def home_layout():
+    exedata = exe_provider.get().exe_tble
     return html.Div(
         children= [
             html.H1("Finance dashboard page, proto"),
@@ -133,11 +203,146 @@ def home_layout():
 ROOT = r"C:\Users\yktkk\Desktop\DS_practice\programing\WebPage"
 nikkei_list_file_path = os.path.join(ROOT, "datadash/dataset/nikkei.csv")
 translation_dict_path = os.path.join(ROOT, "datadash/dataset/financials_translation_dict.json")
-Dataset = D.Data(nikkei_list_file_path=nikkei_list_file_path,
-                translation_dict_path=translation_dict_path)
+# 全銘柄の株価履歴をバックグラウンドで取得しておく (period入力の最大値分)
+PREFETCH_PERIOD = 168
+def load_dataset()->D.Data:
+    dataset = D.Data(nikkei_list_file_path=nikkei_list_file_path,
+                     translation_dict_path=translation_dict_path)
+    threading.Thread(target=dataset.prefetch_history,
+                     kwargs={"period": PREFETCH_PERIOD},
+                     name="history-prefetch", daemon=True).start()
+    return dataset
+dataset_provider = LazyProvider(load_dataset, "dataset")
+
+# server side table
+TABLE_PAGE_SIZE = 50
+FILTER_OPERATORS = [["ge ", ">="], ["le ", "<="], ["lt ", "<"], ["gt ", ">"],
+                    ["ne ", "!="], ["eq ", "="], ["contains "], ["datestartswith "]]
+
+def split_filter_part(filter_part:str):
+    """
+    DataTable の filter_query の1条件 ("{列名} s> 値" など) を (列名, 演算子, 値) に分ける
+    """
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find("{") + 1: name_part.rfind("}")]
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', "`"):
+                    value = value_part[1:-1].replace("\\" + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                # contains などの単語の演算子はフィルター文字列では後ろに空白が必要だが、
+                # 比較に使うときは不要なので取り除いて返す
+                return name, operator_type[0].strip(), value
+    return [None] * 3
+
+class TableIndex:
+    """
+    DataTable の page / sort / filter をサーバー側で行うための表
+
+    列ごとのソート順をキャッシュしておき、表示するページの行だけを返す。
+    """
+
+    def __init__(self,
+                 frame:pd.DataFrame)->None:
+        self.frame = frame.reset_index(drop=True)
+        self._sort_orders = {}
+        self._texts = {}
+
+    def __len__(self)->int:
+        return len(self.frame)
+
+    def sort_order(self,
+                   column:str,
+                   ascending:bool=True)->np.ndarray:
+        """指定列でソートしたときの行番号の並びを返す (同値の並びは元の順序を保つ)"""
+        key = (column, ascending)
+        order = self._sort_orders.get(key)
+        if order is None:
+            values = self.frame[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype(str)
+            order = values.sort_values(ascending=ascending, kind="mergesort").index.to_numpy()
+            self._sort_orders[key] = order
+        return order
+
+    def _text(self,
+              column:str)->pd.Series:
+        """文字列として比較するための列 (category型は文字列にする)"""
+        text = self._texts.get(column)
+        if text is None:
+            text = self.frame[column].astype(str)
+            self._texts[column] = text
+        return text
+
+    def _mask(self,
+              column:str,
+              operator:str,
+              value)->np.ndarray:
+        values = self.frame[column]
+        if operator in ("contains", "datestartswith"):
+            text = self._text(column)
+            if operator == "contains":
+                return text.str.contains(str(value), regex=False).to_numpy()
+            return text.str.startswith(str(value)).to_numpy()
+        if isinstance(value, float) and pd.api.types.is_numeric_dtype(values):
+            target = values
+        else:
+            # 文字列として比較する (数値として解釈された "7203" なども元の表記に戻す)
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            target, value = self._text(column), str(value)
+        compare = {"ge": target.ge, "le": target.le, "lt": target.lt, "gt": target.gt,
+                   "ne": target.ne, "eq": target.eq}[operator]
+        return compare(value).to_numpy()
+
+    def select(self,
+               sort_by:list=None,
+               filter_query:str="")->np.ndarray:
+        """
+        条件に合う行番号を表示順に並べて返す
+
+        :param sort_by: DataTable の sort_by ([{"column_id":..., "direction":"asc"/"desc"}], 先頭のみ使う)
+        :param filter_query: DataTable の filter_query ("{列名} contains 値 && ..." の形式)
+        """
+        mask = np.ones(len(self.frame), dtype=bool)
+        for part in (filter_query or "").split(" && "):
+            column, operator, value = split_filter_part(part)
+            if column not in self.frame.columns:
+                continue
+            mask &= self._mask(column, operator, value)
+        if sort_by and sort_by[0].get("column_id") in self.frame.columns:
+            order = self.sort_order(sort_by[0]["column_id"], sort_by[0].get("direction") != "desc")
+            return order[mask[order]]
+        return np.flatnonzero(mask)
+
+    def page(self,
+             positions:np.ndarray,
+             page_current:int,
+             page_size:int)->list:
+        """表示順の行番号から、page_current ページ目の行を records 形式で返す"""
+        start = page_current * page_size
+        return self.frame.iloc[positions[start:start + page_size]].to_dict("records")
+
+# 読み込んだ Dataset ごとに1つだけ作る
+_nikkei_table = {"version": None, "table": None}
+def nikkei_table()->TableIndex:
+    dataset = dataset_provider.get()
+    if _nikkei_table["version"] != dataset_provider.version:
+        _nikkei_table["table"] = TableIndex(dataset.nikkei)
+        _nikkei_table["version"] = dataset_provider.version
+    return _nikkei_table["table"]
+
+@memoize_layout(dataset_provider)
 def table_layout1():
     # base data
-    df = Dataset.nikkei
+    df = dataset_provider.get().nikkei
     return html.Div(
                 children = [
                     html.H2("Japan finance dashboard"),
@@ -151,7 +356,16 @@ def table_layout1():
                                             dash_table.DataTable(
                                                 id="basetable",
                                                 columns = [{"name":col, "id":col} for col in df.columns],
-                                                data = df.to_dict("records"),
+                                                # 表示するページの行だけを update_basetable で返す
+                                                data = [],
+                                                page_current = 0,
+                                                page_size = TABLE_PAGE_SIZE,
+                                                page_action = "custom",
+                                                sort_action = "custom",
+                                                sort_mode = "single",
+                                                sort_by = [],
+                                                filter_action = "custom",
+                                                filter_query = "",
                                                 fixed_rows = {"headers":True},
                                                 style_table = {"width":"100%"},
                                                 style_cell = {"backgroundColor":"#F8F8FF", "color": "#000000","border": "1px solid #444","textAlign":"left", "paddingLeft":"10px","fontSize":"12px"},
@@ -188,7 +402,9 @@ def table_layout1():
                                             )
                                         ]
                                     ),
-                                    dcc.Graph(id="trendgraph")
+                                    dcc.Graph(id="trendgraph"),
+                                    # 表示中のグラフの銘柄と点の範囲 (部分更新に使う)
+                                    dcc.Store(id="trend-state")
                                 ]
                             )
                         ]
@@ -196,43 +412,90 @@ def table_layout1():
                 ]
             )
 
+# table, server side page / sort / filter
+@app.callback(
+    Output("basetable", "data"),
+    Output("basetable", "page_count"),
+    Output("basetable", "page_current"),
+    Input("basetable", "page_current"),
+    Input("basetable", "page_size"),
+    Input("basetable", "sort_by"),
+    Input("basetable", "filter_query")
+)
+def update_basetable(page_current:int, page_size:int, sort_by:list, filter_query:str):
+    table = nikkei_table()
+    page_size = page_size or TABLE_PAGE_SIZE
+    positions = table.select(sort_by=sort_by, filter_query=filter_query)
+    page_count = max(1, -(-len(positions) // page_size))
+    # フィルターで行数が減った場合は、ページ番号を最後のページに合わせる
+    clamped = min(page_current or 0, page_count - 1)
+    return (table.page(positions, clamped, page_size), page_count,
+            clamped if clamped != page_current else dash.no_update)
+
 # graph,
+def trend_points(trend:pd.DataFrame):
+    """
+    株価履歴をグラフの x (日時の文字列) / y (始値) のリストにする
+    Patchで前後に点を追加できるよう、numpy配列ではなくJSONの配列になるリストにする
+    """
+    if trend is None or trend.empty:
+        return [], []
+    trend = trend.reset_index()
+    dates = trend["Date"]
+    if dates.dt.tz is not None:
+        # 取引所の現地時刻で表示する
+        dates = dates.dt.tz_localize(None)
+    return dates.dt.strftime("%Y-%m-%d %H:%M:%S").tolist(), trend["Open"].tolist()
+
 @app.callback(
     Output("trendgraph", "figure"),
+    Output("trend-state", "data"),
     Input("name", "value"),
-    Input("period", "value")
+    Input("period", "value"),
+    State("trend-state", "data")
 )
-def update_graph(name:str, period:int):
+def update_graph(name:str, period:int, state:dict):
+    Dataset = dataset_provider.get()
     # set company
     code = str(Dataset.nikkei_items[name]["コード"]).zfill(4)
     print("Selected name / code : {} / {}".format(name, code))
-    Dataset.set_company(code=code)
-    # get trend
-    trend = Dataset.gethistory(period=period).reset_index()
-    if trend is None or trend.empty:
+    # get trend (共有の銘柄状態を使わず、コードを指定して取得する)
+    x, y = trend_points(Dataset.history(code=code, period=period))
+    if not x:
         print("Error, Dataset.gethisotry() returned None or empty data")
-    # graph
-    # fig = px.line(
-    #     trend,
-    #     x = "Date",
-    #     y = "Open",
-    #     labels = {"x":"date", "y":"open price"},
-    #     title = "history"
-    # )
-    # fig.update_layout(
-    #     margin = dict(l=5, r=5, t=40, b=5),
-    #     title_x = 0.05, title_y=0.96
-    # )
-    # plotly
-    fig = u.create_trend_plot(
-        dates = trend["Date"].values,
-        values = trend["Open"].values,
-        title = "Trend plot",
-        x_axis_title = "Date",
-        y_axis_title = "Price"
-    )
+    # 表示中の点の範囲
+    new_state = {"code": code, "start": x[0], "end": x[-1], "count": len(x)} if x else None
 
-    return fig
+    # 銘柄が変わった場合は図全体を作る
+    if not state or not x or state["code"] != code:
+        fig = u.create_trend_plot(
+            dates = x,
+            values = y,
+            title = "Trend plot",
+            x_axis_title = "Date",
+            y_axis_title = "Price"
+        )
+        return fig, new_state
+
+    # 同じ銘柄で期間だけ変わった場合は、レイアウトはそのままでデータだけを部分更新する
+    patch = dash.Patch()
+    trace = patch["data"][0]
+    n = len(x) - state["count"]
+    if n > 0 and x[-1] == state["end"] and x[n] == state["start"]:
+        # 新しい日の点が増えた: 履歴は新しい順なので、増えた点を先頭に追加する (反転→末尾に追加→反転)
+        for key, values in (("x", x[:n]), ("y", y[:n])):
+            trace[key].reverse()
+            trace[key].extend(values[::-1])
+            trace[key].reverse()
+    elif n > 0 and x[0] == state["start"] and x[state["count"] - 1] == state["end"]:
+        # 期間を延ばした: 古い側の点だけを末尾に追加する
+        trace["x"].extend(x[state["count"]:])
+        trace["y"].extend(y[state["count"]:])
+    else:
+        # 期間を縮めた場合など: データだけを置き換える
+        trace["x"] = x
+        trace["y"] = y
+    return patch, new_state
 
 # -------------------------------------
 # page transition
@@ -258,4 +521,7 @@ def display_page(pathname, login_status):
         return html.H2("404: ページが見つかりません")
 
 if __name__ == '__main__':
+    # 最初のアクセスを待たせないよう、起動直後からバックグラウンドで読み込んでおく
+    for provider in (users, exe_provider, dataset_provider):
+        provider.warm()
     app.run_server(debug=True)
@@ -1,12 +1,182 @@
 # scatter graph
-import plotly.express as px
-import plotly.graph_objects as go
-import plotly.io as pio
+# plotlyは読み込みが重いので、各関数の中で最初に使うときに読み込む (import plotly.graph_objects as go)
 from typing import Union
 import numpy as np
 import pandas as pd
 
 
+# render mode "auto" で WebGL(Scattergl) に切り替える点数
+WEBGL_THRESHOLD = 5000
+
+# render mode
+def scatter_trace_class(render_mode:str,
+                        n_points:int):
+    """
+    render_mode に応じた散布図のトレースのクラスを返す
+
+    Parameters:
+    - render_mode: str, "svg" (go.Scatter) / "webgl" (go.Scattergl) / "auto" (点数が WEBGL_THRESHOLD を超えたらwebgl)
+    - n_points: int, 描画する点数
+    """
+    import plotly.graph_objects as go
+    if render_mode == "auto":
+        render_mode = "webgl" if n_points > WEBGL_THRESHOLD else "svg"
+    if render_mode == "svg":
+        return go.Scatter
+    if render_mode == "webgl":
+        return go.Scattergl
+    raise ValueError(f"render_mode must be 'svg', 'webgl' or 'auto': {render_mode}")
+
+def _as_numeric(values)->np.ndarray:
+    """数値・日時の配列を float の配列にする (日時は ns の整数値)"""
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.number):
+        return values.astype(float)
+    return pd.to_datetime(values).asi8.astype(float)
+
+# downsampling
+def lttb_indices(x:Union[list,np.array,pd.Series],
+                 y:Union[list,np.array,pd.Series],
+                 n_out:int)->np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets で折れ線を n_out 点に間引き、残す点の行番号を返す
+
+    先頭と末尾の点は必ず残し、間の点を n_out-2 個のバケットに分けて、
+    各バケットから前後の点と作る三角形の面積が最大の点を1つ選ぶ (山や谷の形が残る)。
+
+    Parameters:
+    - x: X軸のデータ (数値または日時、昇順)
+    - y: Y軸のデータ
+    - n_out: int, 間引き後の点数
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = _as_numeric(x)
+    y = np.asarray(y, dtype=float)
+    edges = np.unique(np.linspace(1, n - 1, n_out - 1).astype(int))
+    # 各バケットの平均 (最後のバケットの次は末尾の点だけ)
+    bounds = np.append(edges, n)
+    counts = np.diff(bounds)
+    avg_x = (np.add.reduceat(x, bounds[:-1]) / counts).tolist()
+    avg_y = (np.add.reduceat(y, bounds[:-1]) / counts).tolist()
+    # 欠損値の点は選ばない
+    missing = np.isnan(y)
+    has_missing = missing.any()
+    edges = edges.tolist()
+    indices = [0]
+    xa, ya = x[0], y[0]
+    for i in range(len(edges) - 1):
+        start, stop = edges[i], edges[i + 1]
+        area = np.abs((xa - avg_x[i + 1]) * (y[start:stop] - ya) - (xa - x[start:stop]) * (avg_y[i + 1] - ya))
+        if has_missing:
+            area[missing[start:stop]] = -1.0
+        a = start + int(area.argmax())
+        indices.append(a)
+        xa, ya = x[a], y[a]
+    indices.append(n - 1)
+    return np.asarray(indices)
+
+def grid_decimate_indices(x:Union[list,np.array,pd.Series],
+                          y:Union[list,np.array,pd.Series],
+                          max_points:int,
+                          category:Union[list,np.array,pd.Series] = None)->np.ndarray:
+    """
+    散布図の点を間引き、残す点の行番号を返す
+
+    X-Y平面を約 max_points 個の格子に分け、(カテゴリ, 格子) ごとに最初の1点だけを残す。
+    点が重なって見えない部分だけが減るので、分布の形や外れ値は残る。
+    (カテゴリがある場合は、残る点数は最大で max_points × カテゴリ数)
+
+    Parameters:
+    - x, y: X軸 / Y軸のデータ
+    - max_points: int, 目安の点数
+    - category: カテゴリのデータ (カテゴリごとに間引く)
+    """
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+    bins = max(1, int(np.sqrt(max_points)))
+    def cell(values):
+        values = np.nan_to_num(_as_numeric(values))
+        lo, hi = values.min(), values.max()
+        if hi <= lo:
+            return np.zeros(len(values), dtype=np.int64)
+        return np.clip(((values - lo) / (hi - lo) * bins).astype(np.int64), 0, bins - 1)
+    key = cell(x) * bins + cell(y)
+    if category is not None:
+        key = pd.factorize(np.asarray(category))[0].astype(np.int64) * (bins * bins) + key
+    _, first = np.unique(key, return_index=True)
+    return np.sort(first)
+
+# category split
+def group_indices(category:Union[list,np.array,pd.Series])->list:
+    """
+    カテゴリごとの行番号を1回で求め、[(カテゴリ, 行番号の配列), ...] を出現順に返す
+
+    カテゴリごとにマスクを作る O(n × カテゴリ数) の処理の代わりに、factorize と安定ソートで分ける。
+    (欠損値のカテゴリの行は含めない)
+    """
+    codes, uniques = pd.factorize(np.asarray(category))
+    order = np.argsort(codes, kind="stable")
+    # 欠損値(-1)は先頭に並ぶので除く
+    order = order[np.count_nonzero(codes < 0):]
+    bounds = np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))[:-1]
+    return list(zip(uniques, np.split(order, bounds)))
+
+# box statistics
+def box_statistics(data:Union[list,np.array,pd.Series],
+                   category:Union[list,np.array,pd.Series])->pd.DataFrame:
+    """
+    カテゴリごとの箱ひげ図の統計量を求める
+
+    (カテゴリ, 値) の順に並べ替え、四分位数は位置の計算、ひげの端は reduceat でまとめて求める。
+    四分位数は plotly の既定 (quartilemethod="linear") と同じ線形補間、ひげの端は
+    Q1 - 1.5×IQR 以上の最小値 / Q3 + 1.5×IQR 以下の最大値。欠損値は除く。
+
+    Returns:
+    - pd.DataFrame, 列は category, n, q1, median, q3, lowerfence, upperfence, mean, min, max (カテゴリの出現順)
+    """
+    data = np.asarray(data, dtype=float)
+    category = np.asarray(category)
+    valid = ~np.isnan(data) & pd.notna(category)
+    data, category = data[valid], category[valid]
+    columns = ["category", "n", "q1", "median", "q3", "lowerfence", "upperfence", "mean", "min", "max"]
+    if len(data) == 0:
+        # 有効な値が無い場合はカテゴリも無い (reduceat は空の配列を扱えない)
+        return pd.DataFrame(columns=columns)
+    codes, uniques = pd.factorize(category)
+    # 値でソートしてから、カテゴリで安定ソート (lexsort より速い)
+    order = np.argsort(data)
+    order = order[np.argsort(codes[order], kind="stable")]
+    values, codes = data[order], codes[order]
+    n = np.bincount(codes, minlength=len(uniques))
+    starts = np.concatenate([[0], np.cumsum(n)[:-1]]).astype(np.int64)
+
+    def quantile(p):
+        pos = starts + p * (n - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+    q1, median, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    iqr = q3 - q1
+    index = np.arange(len(values))
+    first = np.minimum.reduceat(np.where(values >= (q1 - 1.5 * iqr)[codes], index, len(values)), starts)
+    last = np.maximum.reduceat(np.where(values <= (q3 + 1.5 * iqr)[codes], index, -1), starts)
+    return pd.DataFrame({
+        "category": uniques,
+        "n": n,
+        "q1": q1,
+        "median": median,
+        "q3": q3,
+        "lowerfence": values[first],
+        "upperfence": values[last],
+        "mean": np.add.reduceat(values, starts) / n,
+        "min": values[starts],
+        "max": values[starts + n - 1],
+    })
+
 # scatter plot
 def create_scatter_plot(x:Union[list,np.array,pd.Series],
                         y:Union[list,np.array,pd.Series],
@@ -15,7 +185,9 @@ def create_scatter_plot(x:Union[list,np.array,pd.Series],
                         x_axis_title:str = 'X Axis',
                         y_axis_title:str = 'Y Axis',
                         output_html:bool = False,
-                        html_filename:str = "scatter_plot.html"
+                        html_filename:str = "scatter_plot.html",
+                        render_mode:str = "auto",
+                        max_points:int = None
                         ):
     """
     散布図を作成する関数
@@ -28,34 +200,42 @@ def create_scatter_plot(x:Union[list,np.array,pd.Series],
     - y_axis_title: str, Y軸のタイトル（デフォルト: 'Y Axis'）
     - output_html: bool, HTML形式で出力する場合はTrue（デフォルト: False）
     - html_filename: str, HTMLファイル名（デフォルト: 'scatter_plot.html'）
+    - render_mode: str, "svg" / "webgl" / "auto"（デフォルト: "auto", 点数が多い場合はwebgl）
+    - max_points: int, 指定した場合は格子ごとに間引いて約この点数にする（デフォルト: None, 間引かない）
 
     Returns:
     - fig: plotly.graph_objects.Figure, 作成した図
     """
 
     # 散布図の作成
+    import plotly.graph_objects as go
     fig = go.Figure()
 
-    # 各カテゴリのデータポイントを追加
-    unique_categories = pd.Series(category).unique()  # カテゴリのユニークな値を取得
+    # 間引き (軸の範囲は間引く前のデータで決める)
+    x_plot, y_plot, category_plot = np.asarray(x), np.asarray(y), np.asarray(category)
+    if max_points is not None:
+        keep = grid_decimate_indices(x_plot, y_plot, max_points, category_plot)
+        x_plot, y_plot, category_plot = x_plot[keep], y_plot[keep], category_plot[keep]
+    trace_class = scatter_trace_class(render_mode, len(x_plot))
+
+    # 各カテゴリのデータポイントを追加 (カテゴリごとの行番号を1回で求める)
+    groups = group_indices(category_plot)
 
     # if color dict
     if category_color!=None:
-        for cat in unique_categories:
-            mask = pd.Series(category) == cat  # 指定カテゴリのデータをフィルタリング
-            fig.add_trace(go.Scatter(
-                x=np.array(x)[mask],
-                y=np.array(y)[mask],
+        for cat, idx in groups:
+            fig.add_trace(trace_class(
+                x=x_plot[idx],
+                y=y_plot[idx],
                 mode='markers',
                 name=str(cat),  # 凡例の名前
                 marker=dict(size=5, color=category_color[cat]),  # マーカーのサイズ
             ))
     else:
-        for cat in unique_categories:
-            mask = pd.Series(category) == cat  # 指定カテゴリのデータをフィルタリング
-            fig.add_trace(go.Scatter(
-                x=np.array(x)[mask],
-                y=np.array(y)[mask],
+        for cat, idx in groups:
+            fig.add_trace(trace_class(
+                x=x_plot[idx],
+                y=y_plot[idx],
                 mode='markers',
                 name=str(cat),  # 凡例の名前
                 marker=dict(size=5),  # マーカーのサイズ
@@ -75,7 +255,7 @@ def create_scatter_plot(x:Union[list,np.array,pd.Series],
     )
 
     # 軸情報の指定
-    fig.update_xaxes(range=[min(x) - 1, max(x) + 1],
+    fig.update_xaxes(range=[np.nanmin(x) - 1, np.nanmax(x) + 1],
                      showgrid=True, 
                      gridcolor="Black",
                      gridwidth = 0.1,
@@ -84,7 +264,7 @@ def create_scatter_plot(x:Union[list,np.array,pd.Series],
                      tickcolor="LightGray",
                      title_font={"size": 18, "color": "Black"},
                      tickfont=dict(color='Black'))  # X軸目盛りの色)
-    fig.update_yaxes(range=[min(y) - 1, max(y) + 1],
+    fig.update_yaxes(range=[np.nanmin(y) - 1, np.nanmax(y) + 1],
                      showgrid=True, 
                      gridcolor="LightGray",
                      gridwidth = 0.1,
@@ -100,13 +280,54 @@ def create_scatter_plot(x:Union[list,np.array,pd.Series],
 
     return fig
 
+# box plot, summary
+def add_box_summary(fig:"go.Figure",
+                    data:Union[list,np.array,pd.Series],
+                    category:Union[list,np.array,pd.Series],
+                    **box_kwargs):
+    """
+    カテゴリごとの統計量(box_statistics)から箱ひげ図を作り、データ数の注釈と一緒に fig に追加する
+
+    Parameters:
+    - fig: plotly.graph_objects.Figure, 追加先の図
+    - data, category: 値とカテゴリのデータ
+    - box_kwargs: go.Box に渡す引数 (色など)
+    """
+    import plotly.graph_objects as go
+    stats = box_statistics(data, category)
+    traces = []
+    annotations = []
+    for row in stats.itertuples(index=False):
+        name = str(row.category)
+        traces.append(go.Box(
+            x=[name],
+            name=name,
+            q1=[row.q1], median=[row.median], q3=[row.q3],
+            lowerfence=[row.lowerfence], upperfence=[row.upperfence],
+            mean=[row.mean],
+            **box_kwargs
+        ))
+        # データ数を注釈として追加
+        annotations.append(dict(
+            x=name,
+            y=row.max * 1.03,  # 注釈位置を調整
+            text=f"N={row.n}",
+            showarrow=False,
+            font=dict(size=12, color="black")
+        ))
+    # トレース・注釈はまとめて追加する
+    fig.add_traces(traces)
+    fig.update_layout(annotations=annotations)
+    return fig
+
 # box plot
 def create_box_plot(data:Union[list,np.array,pd.Series],
                     category:Union[list,np.array,pd.Series],
                     x_axis_title:str = 'X Axis',
                     y_axis_title:str = 'Y Axis',
                     output_html:bool = False,
-                    html_filename:str = "scatter_plot.html"
+                    html_filename:str = "scatter_plot.html",
+                    summary:bool = False
                     ):
     """
     散布図を作成する関数
@@ -118,36 +339,41 @@ def create_box_plot(data:Union[list,np.array,pd.Series],
     - y_axis_title: str, Y軸のタイトル（デフォルト: 'Y Axis'）
     - output_html: bool, HTML形式で出力する場合はTrue（デフォルト: False）
     - html_filename: str, HTMLファイル名（デフォルト: 'scatter_plot.html'）
+    - summary: bool, Trueの場合はカテゴリごとの統計量(四分位数・ひげ・平均)だけを図に渡す（デフォルト: False）
+               図のサイズがデータ数によらずカテゴリ数に比例する。外れ値の点は表示しない
 
     Returns:
     - fig: plotly.graph_objects.Figure, 作成した図
     """
 
     # 散布図の作成
+    import plotly.graph_objects as go
     fig = go.Figure()
-
-    # 各カテゴリのデータポイントを追加
-    unique_categories = pd.Series(category).unique()  # カテゴリのユニークな値を取得
-
-    # each category
-    if category is not None:
-        categories = pd.Series(category).unique()  # カテゴリのユニークな値を取得
-        for cat in categories:
-            mask = pd.Series(category) == cat
-            cat_data = np.array(data)[mask]
+    data = np.asarray(data)
+
+    # each category, 統計量のみ
+    if category is not None and summary:
+        add_box_summary(fig, data, category, boxmean=True)
+    # each category (カテゴリごとの行番号を1回で求める)
+    elif category is not None:
+        annotations = []
+        for cat, idx in group_indices(category):
+            cat_data = data[idx]
             fig.add_trace(go.Box(
                 y=cat_data,             # 指定カテゴリのデータのみ使用
                 name=str(cat),          # 凡例に表示されるカテゴリ名
                 boxmean=True            # 平均値を表示
             ))
             # データ数を注釈として追加
-            fig.add_annotation(
+            annotations.append(dict(
                 x=str(cat),
-                y=max(cat_data) * 1.03,  # 注釈位置を調整
+                y=np.nanmax(cat_data) * 1.03,  # 注釈位置を調整
                 text=f"N={len(cat_data)}",
                 showarrow=False,
                 font=dict(size=12, color="black")
-            )
+            ))
+        # 注釈はまとめて設定する (add_annotation は1回ごとにレイアウト全体を検証するため遅い)
+        fig.update_layout(annotations=annotations)
     else:
         # カテゴリがない場合は全データで1つの箱ひげ図を作成
         fig.add_trace(go.Box(
@@ -158,7 +384,7 @@ def create_box_plot(data:Union[list,np.array,pd.Series],
         # データ数を注釈として追加
         fig.add_annotation(
             x = 0,
-            y= max(data) * 1.05,
+            y= np.nanmax(data) * 1.05,
             text=f"N={len(data)}",
             showarrow=False,
             font=dict(size=12, color="black")
@@ -188,7 +414,8 @@ def create_box_plot(data:Union[list,np.array,pd.Series],
                      title_font={"size": 18, "color": "Black"},
                      tickfont=dict(color='Black'))  # X軸目盛りの色)
     
-    fig.update_yaxes(range=[min(data) - min(data)*0.1, max(data) + max(data)*0.1],
+    data_min, data_max = np.nanmin(data), np.nanmax(data)
+    fig.update_yaxes(range=[data_min - data_min*0.1, data_max + data_max*0.1],
                      showgrid=True,
                      gridcolor="LightGray",
                      gridwidth = 0.1,
@@ -207,7 +434,8 @@ def create_box_plot(data:Union[list,np.array,pd.Series],
 # box plot gray
 def create_box_plot_with_count(data: Union[list, np.ndarray, pd.Series], 
                                category: Union[list, np.ndarray, pd.Series] = None, 
-                               title: str = "Box Plot with Counts"):
+                               title: str = "Box Plot with Counts",
+                               summary: bool = False):
     """
     データ数を注釈として表示する箱ひげ図を作成する関数
 
@@ -215,19 +443,24 @@ def create_box_plot_with_count(data: Union[list, np.ndarray, pd.Series],
     - data: リスト、NumPy配列、またはPandasシリーズのいずれかで指定可能なデータ
     - category: リスト、NumPy配列、またはPandasシリーズのいずれかで指定可能なカテゴリ情報（デフォルトはNone）
     - title: str, グラフのタイトル
+    - summary: bool, Trueの場合はカテゴリごとの統計量(四分位数・ひげ・平均)だけを図に渡す（デフォルト: False）
 
     Returns:
     - fig: plotly.graph_objects.Figure, 作成した箱ひげ図
     """
     
+    import plotly.graph_objects as go
     fig = go.Figure()
-
-    # カテゴリごとにデータを分割して追加し、データ数を注釈として表示
-    if category is not None:
-        categories = pd.Series(category).unique()  # カテゴリのユニークな値を取得
-        for cat in categories:
-            mask = pd.Series(category) == cat
-            cat_data = np.array(data)[mask]
+    data = np.asarray(data)
+
+    # カテゴリごとの統計量だけを追加し、データ数を注釈として表示
+    if category is not None and summary:
+        add_box_summary(fig, data, category, boxmean=True, marker_color="red", line_color="black")
+    # カテゴリごとにデータを分割して追加し、データ数を注釈として表示 (行番号は1回で求める)
+    elif category is not None:
+        annotations = []
+        for cat, idx in group_indices(category):
+            cat_data = data[idx]
             fig.add_trace(go.Box(
                 y=cat_data,             # 指定カテゴリのデータのみ使用
                 name=str(cat),          # 凡例に表示されるカテゴリ名
@@ -236,13 +469,15 @@ def create_box_plot_with_count(data: Union[list, np.ndarray, pd.Series],
                 line_color="black"                # 枠線を黒で表示
             ))
             # データ数を注釈として追加
-            fig.add_annotation(
+            annotations.append(dict(
                 x=str(cat),
-                y=max(cat_data) * 1.03,  # 注釈位置を調整
+                y=np.nanmax(cat_data) * 1.03,  # 注釈位置を調整
                 text=f"N={len(cat_data)}",
                 showarrow=False,
                 font=dict(size=12, color="black")
-            )
+            ))
+        # 注釈はまとめて設定する (add_annotation は1回ごとにレイアウト全体を検証するため遅い)
+        fig.update_layout(annotations=annotations)
     else:
         # カテゴリがない場合は全データで1つの箱ひげ図を作成
         fig.add_trace(go.Box(
@@ -255,7 +490,7 @@ def create_box_plot_with_count(data: Union[list, np.ndarray, pd.Series],
         # データ数を注釈として追加
         fig.add_annotation(
             x = 0,
-            y= max(data) * 1.03,
+            y= np.nanmax(data) * 1.03,
             text=f"N={len(data)}",
             showarrow=False,
             font=dict(size=12, color="black")
@@ -284,7 +519,8 @@ def create_box_plot_with_count(data: Union[list, np.ndarray, pd.Series],
                      title_font={"size": 18, "color": "Black"},
                      tickfont=dict(color='Black'))  # X軸目盛りの色)
     
-    fig.update_yaxes(range=[min(data) - min(data)*0.1, max(data) + max(data)*0.1],
+    data_min, data_max = np.nanmin(data), np.nanmax(data)
+    fig.update_yaxes(range=[data_min - data_min*0.1, data_max + data_max*0.1],
                      showgrid=True,
                      gridcolor="LightGray",
                      gridwidth = 0.1,
@@ -301,7 +537,9 @@ def create_trend_plot(dates: Union[pd.Series, list[pd.Timestamp]],
                       values: Union[pd.Series, list[float]], 
                       title: str = "Trend Plot", 
                       x_axis_title: str = "Date", 
-                      y_axis_title: str = "Value"):
+                      y_axis_title: str = "Value",
+                      render_mode: str = "auto",
+                      max_points: int = None):
     """
     日付をX軸としたトレンドグラフを作成する関数
 
@@ -311,15 +549,24 @@ def create_trend_plot(dates: Union[pd.Series, list[pd.Timestamp]],
     - title: str, グラフのタイトル
     - x_axis_title: str, X軸のタイトル
     - y_axis_title: str, Y軸のタイトル
+    - render_mode: str, "svg" / "webgl" / "auto"（デフォルト: "auto", 点数が多い場合はwebgl）
+    - max_points: int, 指定した場合はLTTBでこの点数に間引く（デフォルト: None, 間引かない）
 
     Returns:
     - fig: plotly.graph_objects.Figure, 作成したトレンドグラフ
     """
 
+    import plotly.graph_objects as go
     fig = go.Figure()
 
+    # 間引き (形が変わらないようにLTTBで選ぶ)
+    if max_points is not None and len(values) > max_points:
+        keep = lttb_indices(dates, values, max_points)
+        dates, values = np.asarray(dates)[keep], np.asarray(values)[keep]
+    trace_class = scatter_trace_class(render_mode, len(values))
+
     # トレンドラインを追加
-    fig.add_trace(go.Scatter(
+    fig.add_trace(trace_class(
         x=dates,
         y=values,
         mode='lines+markers',
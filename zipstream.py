@@ -0,0 +1,81 @@
+# streaming zip writer
+import os
+import zipfile
+
+
+# -------------------------------------------------
+# parameters
+# -------------------------------------------------
+# 1回に読み込んで送り出すサイズ
+CHUNK_SIZE = 1024 * 1024
+
+
+# -------------------------------------------------
+# class / functions
+# -------------------------------------------------
+class _StreamBuffer:
+    """
+    ZipFile の書き込み先にする、書き込んだバイト列を溜めておくだけのファイルオブジェクト
+    seekできないので、ZipFile はデータディスクリプタ形式(先頭に戻らない形式)で書き込む
+    """
+
+    def __init__(self)->None:
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data)->int:
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self)->int:
+        return self._pos
+
+    def flush(self)->None:
+        pass
+
+    def pop(self)->bytes:
+        """溜まっているバイト列を取り出して空にする"""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_zip(members,
+             chunk_size:int=CHUNK_SIZE):
+    """
+    複数のファイルを1つのZIPにまとめながら、少しずつバイト列を返すジェネレーター
+
+    ZIPをディスクやメモリ上に作らずにそのままレスポンスとして流せる。
+    メンバーは既に圧縮済みのZIPファイルを想定しているので、無圧縮(ZIP_STORED)で格納する。
+    メモリ使用量は chunk_size 程度で、まとめるファイルの数や大きさによらない。
+
+    :param members: (ファイルのパス, ZIP内での名前) のイテラブル
+    :param chunk_size: 1回に読み込むサイズ
+    """
+    buf = _StreamBuffer()
+    with zipfile.ZipFile(buf, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for path, arcname in members:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as src, zf.open(zinfo, mode="w", force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield buf.pop()
+            yield buf.pop()
+    # 末尾のセントラルディレクトリ
+    yield buf.pop()
+
+def existing_members(paths):
+    """
+    存在するファイルだけを (パス, ファイル名) にして返す (同じファイル名は最初の1つだけ)
+    """
+    seen = set()
+    for path in paths:
+        name = os.path.basename(path)
+        if name in seen or not os.path.isfile(path):
+            continue
+        seen.add(name)
+        yield path, name